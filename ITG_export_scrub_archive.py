@@ -0,0 +1,110 @@
+"""
+ITG_export_scrub_archive.py
+
+Author: Josh Smith
+
+Purpose: Zip scrubber output with a chosen compression method and level,
+and stream the outputs of many clients into a single bundle archive.
+Workbooks and parquet files are already compressed, so outputs are
+stored by default. Uses the standard library zipfile, which unlike
+zipfile36 takes a compression level.
+See 'TPG ITG Export Scrubber Specification.rst' for more info.
+"""
+
+# imports
+import os
+from os.path import basename
+import zipfile
+
+
+# Compression methods by name
+ZIP_COMPRESSION = {
+    'stored': zipfile.ZIP_STORED,
+    'deflated': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA,
+}
+
+# Output is already compressed, so only pack it
+DEFAULT_COMPRESSION = 'stored'
+
+
+def parse_compression(spec) -> tuple:
+    """Parse a compression setting of method[:level], e.g. 'stored',
+    'deflated' or 'deflated:1'
+
+    :param spec: compression setting string
+    :return: tuple of zipfile compression constant and level (or None
+    for the method's default level)
+    """
+
+    method, _, level = spec.partition(':')
+    if method not in ZIP_COMPRESSION:
+        raise ValueError(f'Unknown compression {method}. '
+                         f'Use one of {", ".join(ZIP_COMPRESSION)}.')
+    if not level:
+        return ZIP_COMPRESSION[method], None
+    if method == 'stored':
+        raise ValueError('stored does not take a compression level.')
+    return ZIP_COMPRESSION[method], int(level)
+
+
+def open_archive(path, compression=DEFAULT_COMPRESSION) -> zipfile.ZipFile:
+    """Create a new zip for writing
+
+    :param path: path of the zip file to create
+    :param compression: compression setting, see parse_compression()
+    :return: zipfile.ZipFile open for writing
+    """
+
+    method, level = parse_compression(compression)
+    return zipfile.ZipFile(path, 'w', method, compresslevel=level)
+
+
+def add_to_archive(archive, path, arcname=None) -> None:
+    """Stream a file, or every file directly inside a directory, into
+    an open archive. Files are read in chunks, nothing is copied.
+
+    :param archive: zipfile.ZipFile open for writing
+    :param path: file or directory (such as parquet output) to add
+    :param arcname: name inside the archive, defaults to the base name
+    """
+
+    arcname = arcname or basename(path)
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            archive.write(os.path.join(path, name), f'{arcname}/{name}')
+    else:
+        archive.write(path, arcname)
+
+
+class OutputBundle:
+    """One archive holding the outputs of every client in a batch.
+    Outputs are added as each export finishes."""
+
+    def __init__(self, path, compression=DEFAULT_COMPRESSION):
+        self.path = path
+        self.archive = open_archive(path, compression)
+        self.names = set()
+
+    def add(self, output) -> None:
+        """Add one client's output. Outputs with the same name from
+        different directories are kept under their directory name.
+
+        :param output: path of a workbook, zip or parquet directory
+        """
+
+        arcname = basename(output)
+        if arcname in self.names:
+            arcname = f'{basename(os.path.dirname(output))}/{arcname}'
+        self.names.add(arcname)
+        add_to_archive(self.archive, output, arcname)
+
+    def close(self) -> None:
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
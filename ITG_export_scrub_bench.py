@@ -0,0 +1,315 @@
+"""
+ITG_export_scrub_bench.py
+
+Author: Josh Smith
+
+Purpose: Benchmark the scrub engine. Generate synthetic ITG export zips
+shaped like the real keep_csv files, run process_exports on each one,
+and emit the time spent per phase as JSON so runs can be compared.
+Also measures how long each entry point takes to import, in a fresh
+interpreter, and which heavy dependencies that import loads.
+See 'TPG ITG Export Scrubber Specification.rst' for more info.
+"""
+
+# imports
+import argparse
+import csv
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from zipfile36 import ZipFile, ZIP_DEFLATED
+import ITG_export_scrub_engine as engine
+
+
+# Columns of each generated csv. Names follow real ITG exports so the
+# rules file deletes, keeps and sorts them the same way.
+EXPORT_LAYOUT = {
+    'configurations.csv': [
+        'id', 'organization', 'Name', 'hostname', 'configuration_type',
+        'configuration_status', 'manufacturer', 'model', 'serial_number',
+        'asset_tag', 'Operating System', 'primary_ip', 'mac_address',
+        'installed_by', 'location', 'contact', 'notes',
+        'configuration_interfaces', 'archived',
+    ],
+    'passwords.csv': [
+        'id', 'organization', 'name', 'username', 'password', 'url',
+        'notes', 'one_time_password', 'resource_type', 'resource_id',
+        'archived',
+    ],
+    'vendors.csv': [
+        'id', 'organization', 'Vendor Name', 'Phone', 'Website',
+        'Account Number', 'Notes', 'Category', 'Business Impact',
+        'archived',
+    ],
+    'applications-licensing.csv': [
+        'id', 'organization', 'Name', 'Version', 'License Key',
+        'Seats', 'Renewal Date', 'Notes', 'Importance', 'archived',
+    ],
+    'backups-managed.csv': [
+        'id', 'organization', 'Description', 'Backup Software',
+        'Backup Target', 'Schedule', 'Backup Copy Job Name',
+        'Backup Radar Reporting Notes', 'Notes', 'archived',
+    ],
+    'email.csv': [
+        'id', 'organization', 'Name', 'Email Type', 'Domain(s)',
+        'Webmail URL', 'Notes', 'archived',
+    ],
+    'internet-wan.csv': [
+        'id', 'organization', 'Name', 'ISP', 'Circuit ID', 'IP Address',
+        'Subnet Mask', 'Default Gateway Device', 'Notes', 'archived',
+    ],
+    'lan.csv': [
+        'id', 'organization', 'Name', 'Subnet', 'VLAN #', 'DHCP Server',
+        'DHCP Scope', 'DNS Server(s)', 'Notes', 'archived',
+    ],
+    'printing.csv': [
+        'id', 'organization', 'Printer Name', 'Model', 'IP Address',
+        'Printer Management Login', 'Notes', 'archived',
+    ],
+    'wireless.csv': [
+        'id', 'organization', 'Name', 'SSID', 'Security', 'Access Point(s)',
+        'Firewall', 'Notes', 'archived',
+    ],
+}
+
+# Entry points whose import time is measured
+ENTRY_MODULES = ('ITG_export_scrub_cli', 'ITG_export_scrub_gui',
+                 'ITG_export_scrub_engine')
+
+# Cell values repeated across rows like in real exports
+COMMON_VALUES = ['Yes', 'No', 'Active', 'Windows 11 Pro',
+                 'Windows Server 2019', 'Dell Inc.', 'Ubiquiti', 'N/A']
+
+# Note templates. Real exports repeat the same html boilerplate
+HTML_VALUES = [
+    '<p>Standard password note. Rotate every <b>90</b> days.</p>',
+    '<div><p>Vendor support:&nbsp;<a href="https://example.com">'
+    'portal</a></p><ul><li>Tier 1</li><li>Tier 2</li></ul></div>',
+    '<p>Managed by TPG &amp; client IT</p>',
+]
+
+# Values with characters that unicode normalization changes
+UNICODE_VALUES = ['Café ﬁle server', 'Zürich office', 'ＦＵＬＬ ＷＩＤＴＨ',
+                  'Ω resistor bench', 'naïve façade']
+
+
+def make_cell(column, rng, customer_name, html_density, unicode_density):
+    """Return one synthetic cell for column"""
+
+    if column == 'organization':
+        return customer_name
+    if column == 'archived':
+        return 'Yes' if rng.random() < 0.1 else 'No'
+    if column == 'configuration_status':
+        return 'Active' if rng.random() < 0.8 else 'Inactive'
+    if column in ('id', 'resource_id'):
+        return str(rng.randint(1000000, 9999999))
+    roll = rng.random()
+    if roll < html_density:
+        return rng.choice(HTML_VALUES)
+    if roll < html_density + unicode_density:
+        return rng.choice(UNICODE_VALUES)
+    if roll < 0.35:
+        return ''
+    if roll < 0.7:
+        return rng.choice(COMMON_VALUES)
+    return f'{column} {rng.randint(0, 99999)}'
+
+
+def make_export(path, customer_name, rows=1000, html_density=0.05,
+                unicode_density=0.02, seed=0) -> None:
+    """Write a synthetic ITG export zip
+
+    :param path: zip file path to create
+    :param customer_name: organization written to column B
+    :param rows: data rows per csv
+    :param html_density: share of cells holding html (0-1)
+    :param unicode_density: share of cells needing normalization (0-1)
+    :param seed: random seed so exports are reproducible
+    """
+
+    rng = random.Random(seed)
+    with ZipFile(path, 'w', ZIP_DEFLATED) as out_zip:
+        for file, headers in EXPORT_LAYOUT.items():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator='\n')
+            writer.writerow(headers)
+            for _ in range(rows):
+                writer.writerow([make_cell(column, rng, customer_name,
+                                           html_density, unicode_density)
+                                 for column in headers])
+            out_zip.writestr(file, buffer.getvalue())
+        # Exports contain other files that are ignored
+        out_zip.writestr('documents.csv', 'id,organization,name\n')
+
+
+def measure_import(module) -> dict:
+    """Import module in a new interpreter with -X importtime
+
+    :param module: name of the module to import
+    :return: dictionary of import seconds and the engine's heavy
+    dependencies (engine.HEAVY_MODULES) the import loaded, or of the
+    error if the module cannot be imported here (e.g. the gui on a
+    Python built without Tk)
+    """
+
+    code = (f'import sys, json, {module}\n'
+            f'print(json.dumps([m for m in {engine.HEAVY_MODULES!r} '
+            f'if m in sys.modules]))')
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        lines = completed.stderr.strip().splitlines()
+        return {'error': lines[-1] if lines else
+                f'exit code {completed.returncode}'}
+    # Lines are "import time: self [us] | cumulative | name"
+    micros = 0
+    for line in completed.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            micros = int(fields[1])
+    return {
+        'seconds': round(micros / 1e6, 4),
+        'heavy_modules_loaded': json.loads(completed.stdout),
+    }
+
+
+def run_benchmark(clients=3, rows=1000, html_density=0.05,
+                  unicode_density=0.02, zip_task='No', low_memory=False,
+                  work_dir=None, progress=None,
+                  output_format='xlsx', html_cache=None) -> dict:
+    """Generate exports and time process_exports on each of them
+
+    :param clients: number of exports to generate
+    :param rows: data rows per csv
+    :param html_density: share of cells holding html (0-1)
+    :param unicode_density: share of cells needing normalization (0-1)
+    :param zip_task: 'Yes' to include the output zip phase
+    :param low_memory: use the low memory streaming writer
+    :param work_dir: directory for exports and output. A temporary
+                    directory is used and removed when not given.
+    :param progress: optional callable taking a status message string.
+    :param output_format: one of engine.OUTPUT_FORMATS
+    :param html_cache: optional path of the persistent html cache
+    :return: dictionary of benchmark settings, per client results
+    and phase totals
+    """
+
+    progress = progress or (lambda message: None)
+    options = engine.ScrubOptions(zip_task=zip_task, low_memory=low_memory,
+                                  output_format=output_format,
+                                  html_cache=html_cache)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = work_dir or temp_dir
+        os.makedirs(work_dir, exist_ok=True)
+        results = []
+        for i in range(clients):
+            customer_name = f'Bench Client {i}'
+            input_zip = os.path.join(work_dir, f'bench_export_{i}.zip')
+            make_export(input_zip, customer_name, rows, html_density,
+                        unicode_density, seed=i)
+
+            timer = engine.PhaseTimer()
+            start = time.perf_counter()
+            err = engine.process_exports(input_zip, options, timer=timer)
+            total = time.perf_counter() - start
+            progress(f'{customer_name}: {total:.2f}s')
+            results.append({
+                'client': customer_name,
+                'error': err,
+                'input_bytes': os.path.getsize(input_zip),
+                'total_seconds': round(total, 4),
+                'phases': {k: round(v, 4) for k, v in timer.phases.items()},
+            })
+
+    phase_totals = {}
+    for result in results:
+        for phase, seconds in result['phases'].items():
+            phase_totals[phase] = round(phase_totals.get(phase, 0.0)
+                                        + seconds, 4)
+    return {
+        'settings': {
+            'clients': clients,
+            'rows': rows,
+            'csv_files': len(EXPORT_LAYOUT),
+            'html_density': html_density,
+            'unicode_density': unicode_density,
+            'zip_task': zip_task,
+            'low_memory': low_memory,
+            'output_format': output_format,
+            'html_cache': html_cache,
+            'python': platform.python_version(),
+        },
+        'results': results,
+        'phase_totals': phase_totals,
+        'total_seconds': round(sum(r['total_seconds'] for r in results), 4),
+        'cell_cache': engine.cell_cache_stats(),
+    }
+
+
+def main(argv=None) -> int:
+    """Parse arguments, run the benchmark and write JSON results"""
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the ITG export scrubber on synthetic '
+                    'exports.'
+    )
+    parser.add_argument('--clients', type=int, default=3,
+                        help='number of exports to generate (default: 3)')
+    parser.add_argument('--rows', type=int, default=1000,
+                        help='data rows per csv (default: 1000)')
+    parser.add_argument('--html-density', type=float, default=0.05,
+                        help='share of cells holding html (default: 0.05)')
+    parser.add_argument('--unicode-density', type=float, default=0.02,
+                        help='share of cells needing unicode '
+                             'normalization (default: 0.02)')
+    parser.add_argument('--zip', dest='zip_task', choices=['Yes', 'No'],
+                        default='No',
+                        help='zip the output to time the zip phase')
+    parser.add_argument('--low-memory', action='store_true',
+                        help='use the low memory streaming writer')
+    parser.add_argument('--format', dest='output_format',
+                        choices=engine.OUTPUT_FORMATS, default='xlsx',
+                        help='output format to time (default: xlsx)')
+    parser.add_argument('--imports', action='store_true',
+                        help='only measure the import time of the entry '
+                             'points')
+    parser.add_argument('--html-cache',
+                        help='time with this persistent html cache file. '
+                             'Run twice to time a warm cache')
+    parser.add_argument('--work-dir',
+                        help='keep generated exports and output here')
+    parser.add_argument('-o', '--output',
+                        help='write JSON results to this file '
+                             'instead of stdout')
+    args = parser.parse_args(argv)
+
+    report = {}
+    if not args.imports:
+        report = run_benchmark(args.clients, args.rows, args.html_density,
+                               args.unicode_density, args.zip_task,
+                               args.low_memory, args.work_dir,
+                               progress=lambda m: print(m, file=sys.stderr),
+                               output_format=args.output_format,
+                               html_cache=args.html_cache)
+    report['imports'] = {module: measure_import(module)
+                         for module in ENTRY_MODULES}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+"""
+ITG_export_scrub_cache.py
+
+Author: Josh Smith
+
+Purpose: Persistent cache of cleaned html cells, shared by every run and
+worker process of a deployment. The same note templates and vendor
+boilerplate show up in the exports of many clients, so each one only has
+to go through the html parser once. Cells are kept in a local SQLite
+file keyed by a hash of the raw cell, and the least recently used are
+evicted once the cache grows past its size limit.
+See 'TPG ITG Export Scrubber Specification.rst' for more info.
+"""
+
+# imports
+import hashlib
+import logging
+import sqlite3
+import time
+
+
+# Bump when clean_cell() changes what it returns, so old entries
+# are no longer found
+CACHE_VERSION = 1
+
+# Size of cached keys and text the cache is trimmed back to
+DEFAULT_CACHE_BYTES = 64 * 2 ** 20
+
+# Seconds to wait for another process writing to the cache
+LOCK_TIMEOUT = 30
+
+logger = logging.getLogger(__name__)
+
+
+def cell_key(cell) -> bytes:
+    """Hash a raw cell into a cache key
+
+    :param cell: raw csv cell string
+    :return: 16 byte digest
+    """
+
+    return hashlib.blake2b(f'{CACHE_VERSION}\0{cell}'.encode('utf-8'),
+                           digest_size=16).digest()
+
+
+class HtmlCache:
+    """Cleaned text of raw html cells, kept in a SQLite file.
+    Lookups read the file directly. New entries, and the last use of
+    cells found, are held in memory and written in one transaction by
+    flush(). A cache that cannot be read or written is switched off
+    with a warning, it never fails an export."""
+
+    def __init__(self, path, max_bytes=DEFAULT_CACHE_BYTES):
+        """
+        :param path: SQLite file, created if missing. Keep it on a
+                        local disk, SQLite locking is not reliable on
+                        network shares.
+        :param max_bytes: size the cache is trimmed back to on flush
+        """
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.connection = None
+        self.disabled = False
+        self.pending = {}
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open the cache file on first use"""
+
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path,
+                                              timeout=LOCK_TIMEOUT)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            with self.connection:
+                self.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS cells (key BLOB PRIMARY '
+                    'KEY, text TEXT NOT NULL, size INTEGER NOT NULL, '
+                    'used REAL NOT NULL) WITHOUT ROWID'
+                )
+                self.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS cells_used ON cells (used)'
+                )
+        return self.connection
+
+    def _disable(self, action, err) -> None:
+        """Stop using the cache after an error"""
+
+        logger.warning(f'HTML cache {self.path} could not be {action} '
+                       f'({err}), continuing without it')
+        self.disabled = True
+        self.pending.clear()
+        self.used.clear()
+
+    def get(self, cell):
+        """Return the cleaned text of cell, or None if not cached
+
+        :param cell: raw csv cell string
+        """
+
+        if self.disabled:
+            return None
+        key = cell_key(cell)
+        text = self.pending.get(key)
+        if text is None:
+            try:
+                row = self._connect().execute(
+                    'SELECT text FROM cells WHERE key = ?', (key,)
+                ).fetchone()
+            except sqlite3.Error as err:
+                self._disable('read', err)
+                return None
+            if row is None:
+                self.misses += 1
+                return None
+            text = row[0]
+            self.used.add(key)
+        self.hits += 1
+        return text
+
+    def put(self, cell, text) -> None:
+        """Add the cleaned text of cell, written on the next flush()
+
+        :param cell: raw csv cell string
+        :param text: cleaned cell string
+        """
+
+        if not self.disabled:
+            self.pending[cell_key(cell)] = text
+
+    def flush(self) -> None:
+        """Write new entries and last use times, then evict the least
+        recently used entries if the cache is over max_bytes"""
+
+        if self.disabled or not (self.pending or self.used):
+            return
+        now = time.time()
+        try:
+            connection = self._connect()
+            with connection:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO cells VALUES (?, ?, ?, ?)',
+                    [(key, text, len(key) + len(text.encode('utf-8')), now)
+                     for key, text in self.pending.items()]
+                )
+                connection.executemany(
+                    'UPDATE cells SET used = ? WHERE key = ?',
+                    [(now, key) for key in self.used]
+                )
+                self._evict(connection)
+        except sqlite3.Error as err:
+            self._disable('written', err)
+            return
+        self.pending.clear()
+        self.used.clear()
+
+    def _evict(self, connection) -> None:
+        """Delete the least recently used entries until the cache is
+        back under 90% of max_bytes"""
+
+        total = connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM cells').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = total - self.max_bytes * 0.9
+        freed = 0
+        evict = []
+        for key, size in connection.execute(
+                'SELECT key, size FROM cells ORDER BY used'):
+            evict.append((key,))
+            freed += size
+            if freed >= target:
+                break
+        connection.executemany('DELETE FROM cells WHERE key = ?', evict)
+        logger.debug(f'HTML cache evicted {len(evict)} cells')
+
+    def stats(self) -> dict:
+        """Return hit/miss counters of this process"""
+
+        return {'hits': self.hits, 'misses': self.misses,
+                'pending': len(self.pending), 'disabled': self.disabled}
+
+    def close(self) -> None:
+        """Flush and close the cache file"""
+
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
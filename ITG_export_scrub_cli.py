@@ -0,0 +1,234 @@
+"""
+ITG_export_scrub_cli.py
+
+Author: Josh Smith
+
+Purpose: Command line entry point for the ITG export scrubber.
+Runs the headless scrub engine over zip files and/or directories
+of zip files without loading tkinter.
+See 'TPG ITG Export Scrubber Specification.rst' for more info.
+"""
+
+# imports
+import argparse
+import logging
+import os
+import sys
+import ITG_export_scrub_engine as engine
+from ITG_export_scrub_watch import FolderWatcher
+from ITG_export_scrub_rules import load_rules, DEFAULT_RULES_FILE
+from ITG_export_scrub_archive import parse_compression, DEFAULT_COMPRESSION
+from ITG_export_scrub_errors import summary_path, DEFAULT_RETRIES, \
+    DEFAULT_RETRY_DELAY
+
+
+def compression_setting(spec) -> str:
+    """argparse type for --compression. Check the setting parses."""
+
+    try:
+        parse_compression(spec)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err))
+    return spec
+
+
+def megabytes(size):
+    """Convert a size in MB from the command line to bytes"""
+
+    return int(size * 2 ** 20) if size else None
+
+
+def scrub_options(args) -> engine.ScrubOptions:
+    """Build the options of every export from the parsed arguments"""
+
+    return engine.ScrubOptions(
+        post_task=args.post_job,
+        zip_task=args.zip_task,
+        low_memory=args.low_memory,
+        output_format=args.output_format,
+        compression=args.compression,
+        report=args.report,
+        profile=args.profile,
+        html_cache=args.html_cache,
+        delta=args.delta,
+        memory_budget=megabytes(args.memory_budget),
+        time_limit=args.time_limit
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Build the argument parser for the command line entry point"""
+
+    parser = argparse.ArgumentParser(
+        description='Scrub TPG ITG exports into a single workbook '
+                    'per client.'
+    )
+    parser.add_argument('targets', nargs='+',
+                        help='export zip files and/or directories '
+                             'containing export zip files')
+    parser.add_argument('--post-job', choices=['Delete', 'Keep'],
+                        default='Keep',
+                        help='delete or keep the original export '
+                             'when finished (default: Keep)')
+    parser.add_argument('--zip', dest='zip_task', choices=['Yes', 'No'],
+                        default='No',
+                        help='zip the output when finished (default: No)')
+    parser.add_argument('-w', '--workers', type=int,
+                        default=engine.default_workers(),
+                        help='number of exports to process in parallel, '
+                             'or csv\'s of a single export '
+                             '(default: number of CPUs)')
+    parser.add_argument('--compression', type=compression_setting,
+                        default=DEFAULT_COMPRESSION,
+                        help='compression of output zips and the bundle '
+                             'as method[:level], method one of stored, '
+                             'deflated, bzip2 or lzma, e.g. deflated:1 '
+                             '(default: stored, workbooks are already '
+                             'compressed)')
+    parser.add_argument('--bundle',
+                        help='also stream the output of every export into '
+                             'this one zip')
+    parser.add_argument('--format', dest='output_format',
+                        choices=engine.OUTPUT_FORMATS, default='xlsx',
+                        help='xlsx workbook for clients (default), csv '
+                             'zip of UTF-8 csv\'s or parquet directory '
+                             '(needs pyarrow) for internal use')
+    parser.add_argument('--html-cache',
+                        help='SQLite file caching cleaned html cells '
+                             'across runs and clients, so common notes '
+                             'are only parsed once. Keep it on a local '
+                             'disk')
+    parser.add_argument('--delta', action='store_true',
+                        help='also write the rows added, removed and '
+                             'modified since the last scrub of each client '
+                             'to <customer>_export_delta.xlsx (not in low '
+                             'memory mode)')
+    parser.add_argument('--memory-budget', type=float,
+                        help='MB one export may hold in memory. Exports '
+                             'estimated to need more are processed in low '
+                             'memory mode. Each worker scrubs its own '
+                             'export, so allow for workers x budget')
+    parser.add_argument('--time-limit', type=float,
+                        help='seconds one export may take before it is '
+                             'stopped and logged as an error')
+    parser.add_argument('--low-memory', action='store_true',
+                        help='stream each csv straight into the workbook '
+                             'instead of holding sheets in memory. '
+                             'Sheets get a header filter instead of a '
+                             'table and keep export row order')
+    parser.add_argument('--rules', default=DEFAULT_RULES_FILE,
+                        help='JSON scrub rules file (default: the rules '
+                             'file shipped with the scrubber)')
+    parser.add_argument('--report', action='store_true',
+                        help='append per phase and per sheet statistics '
+                             'to ITG_scrubber_report_<date>.jsonl next to '
+                             'the workbooks')
+    parser.add_argument('--profile', action='store_true',
+                        help='dump cProfile stats for every export to '
+                             '<zip name>_profile.prof')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='scrub every export, even ones the manifest '
+                             'shows are already up to date')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                        help='times an export that failed for a transient '
+                             'reason (file locked, share unavailable) is '
+                             f'retried (default: {DEFAULT_RETRIES})')
+    parser.add_argument('--retry-delay', type=float,
+                        default=DEFAULT_RETRY_DELAY,
+                        help='seconds before the first retry, doubled on '
+                             'every further retry (default: '
+                             f'{DEFAULT_RETRY_DELAY:g})')
+    parser.add_argument('--summary',
+                        help='write the JSON batch summary to this file '
+                             '(default: ITG_scrubber_summary_<time>.json '
+                             'in the first target directory)')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and scrub export zips as they '
+                             'arrive in the target directories, until '
+                             'Ctrl+C')
+    parser.add_argument('--interval', type=float, default=5.0,
+                        help='seconds between directory scans in watch '
+                             'mode (default: 5)')
+    parser.add_argument('--settle', type=float, default=10.0,
+                        help='seconds a zip must stay the same size in '
+                             'watch mode before it is scrubbed '
+                             '(default: 10)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not print progress messages')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log debug details such as cell cache '
+                             'hit/miss counters')
+    return parser
+
+
+def main(argv=None) -> int:
+    """Parse arguments and run the batch
+
+    :param argv: argument list, defaults to sys.argv[1:]
+    :return: exit code. 0 means no error occurred,
+    1 means at least one export logged an error,
+    2 means the arguments or rules file could not be used.
+    """
+
+    args = build_parser().parse_args(argv)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG,
+                            format='%(levelname)s %(message)s')
+    progress = None if args.quiet else print
+    try:
+        rules = load_rules(args.rules)
+    except (OSError, ValueError) as err:
+        print(f'Could not load rules file {args.rules}: {err}',
+              file=sys.stderr)
+        return 2
+
+    options = scrub_options(args)
+    if args.watch:
+        not_dirs = [t for t in args.targets if not os.path.isdir(t)]
+        if not_dirs:
+            print(f'Watch mode needs directories, not: '
+                  f'{", ".join(not_dirs)}', file=sys.stderr)
+            return 2
+        watcher = FolderWatcher(args.targets, options,
+                                workers=args.workers,
+                                rules=rules,
+                                interval=args.interval,
+                                settle=args.settle,
+                                force=args.force,
+                                progress=progress,
+                                retries=args.retries,
+                                retry_wait=args.retry_delay)
+        counts = watcher.run()
+        if progress:
+            progress(', '.join(f'{count} {status}'
+                               for status, count in counts.items()))
+        return 1 if counts['failed'] else 0
+
+    # Summary goes next to the first target's exports by default
+    summary = args.summary
+    if not summary:
+        first = os.path.abspath(args.targets[0])
+        summary = summary_path(first if os.path.isdir(first)
+                               else os.path.dirname(first))
+    results = engine.run_batch(args.targets, options,
+                               progress=progress,
+                               workers=args.workers,
+                               rules=rules,
+                               force=args.force,
+                               bundle=args.bundle,
+                               retries=args.retries,
+                               retry_wait=args.retry_delay,
+                               summary=summary)
+    if progress:
+        progress(f'Batch summary written to {summary}')
+    err_count = sum(1 for result in results.values()
+                    if result == engine.RESULT_ERROR)
+    if err_count:
+        print(f'{err_count} export(s) had errors. Please refer to the '
+              f'error file in the target directory.', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
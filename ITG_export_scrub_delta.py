@@ -0,0 +1,291 @@
+"""
+ITG_export_scrub_delta.py
+
+Author: Josh Smith
+
+Purpose: Report what changed in a client's documentation since the last
+scrub. A compact snapshot of every cleaned sheet is kept per client, with
+each row keyed by its ITG id (or its sorter columns) and reduced to a
+64 bit hash. The next scrub is compared against it through hash indexes,
+in time linear in the number of rows, and the added, removed and
+modified rows are written to a small delta workbook.
+See 'TPG ITG Export Scrubber Specification.rst' for more info.
+"""
+
+# imports
+import os
+import datetime
+import gzip
+import json
+
+
+# Snapshot file format. Bump when row keys or hashes change.
+SNAPSHOT_VERSION = 1
+
+# Directory next to the exports holding one snapshot per client
+SNAPSHOT_DIR = 'ITG_scrubber_snapshots'
+
+# Odd 64 bit constant that spreads each cell hash before the cell
+# hashes of a row are added up
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+
+# Delta workbook sheets, after the summary
+CHANGE_COLUMNS = ['Change', 'Changed Columns']
+SUMMARY_SHEET = 'Summary'
+
+
+def snapshot_path(working_dir, customer_name) -> str:
+    """Return the path of a client's snapshot
+
+    :param working_dir: directory the client's exports are in
+    :param customer_name: organization name from the export
+    :return: full path to the gzipped json file
+    """
+
+    return os.path.join(working_dir, SNAPSHOT_DIR,
+                        f'{customer_name}_snapshot.json.gz')
+
+
+def delta_file(working_dir, customer_name) -> str:
+    """Return the path of a client's delta workbook"""
+
+    return os.path.join(working_dir, f'{customer_name}_export_delta.xlsx')
+
+
+def _text_column(column):
+    """Cells of a compacted column as the text the export held,
+    blank cells as ''"""
+
+    import pandas as pd
+
+    if pd.api.types.is_datetime64_any_dtype(column.dtype):
+        return column.dt.strftime('%Y-%m-%d').astype(object).fillna('')
+    if pd.api.types.is_numeric_dtype(column.dtype):
+        return column.astype('string').astype(object).fillna('')
+    return column.astype(object)
+
+
+def _unique_keys(keys) -> list:
+    """Number repeats of a key, so every row has its own key"""
+
+    seen = {}
+    unique = []
+    for key in keys:
+        count = seen.get(key, 0) + 1
+        seen[key] = count
+        unique.append(key if count == 1 else f'{key}#{count}')
+    return unique
+
+
+def sheet_snapshot(df, key_columns=()) -> dict:
+    """Reduce a cleaned sheet to its snapshot. Rows are keyed by the
+    ITG id the engine keeps as the sheet's index, else by the
+    key_columns, else by their own hash. Each row hash adds up one
+    hash per non blank cell, so columns added or dropped empty do not
+    change it.
+
+    :param df: pandas DataFrame of a compacted sheet
+    :param key_columns: sort columns to key rows by without an id
+    :return: dictionary of columns, keys, hashes and text rows
+    """
+
+    import numpy as np
+    import pandas as pd
+
+    columns = [str(col) for col in df.columns]
+    texts = [_text_column(df.iloc[:, i]) for i in range(df.shape[1])]
+
+    # Vectorized row hashes. uint64 arithmetic wraps around.
+    hashes = np.zeros(len(df), dtype=np.uint64)
+    multiplier = np.uint64(HASH_MULTIPLIER)
+    with np.errstate(over='ignore'):
+        for name, text in zip(columns, texts):
+            cell_hashes = pd.util.hash_pandas_object(
+                text, index=False).to_numpy()
+            name_hash = pd.util.hash_array(np.array([name], dtype=object))
+            mixed = (cell_hashes ^ name_hash[0]) * multiplier
+            hashes += np.where(text.to_numpy() == '', np.uint64(0), mixed)
+    hashes = hashes.tolist()
+
+    if df.index.name == 'id':
+        keys = [str(key) for key in df.index]
+    elif key_columns:
+        key_texts = [_text_column(df[col]).tolist() for col in key_columns]
+        keys = ['\x1f'.join(parts) for parts in zip(*key_texts)]
+    else:
+        keys = [format(row_hash, '016x') for row_hash in hashes]
+
+    return {
+        'columns': columns,
+        'keys': _unique_keys(keys),
+        'hashes': hashes,
+        'rows': [list(row) for row in zip(*(t.tolist() for t in texts))],
+    }
+
+
+def diff_sheet(old, new) -> dict:
+    """Compare two snapshots of one sheet through a hash index of the
+    old row keys. Either may be None when the sheet is new or gone.
+
+    :return: dictionary of added and removed row numbers, and modified
+    (new row number, old row number) pairs
+    """
+
+    old_index = {key: i for i, key in enumerate(old['keys'])} if old else {}
+    added = []
+    modified = []
+    unchanged = 0
+    if new:
+        old_hashes = old['hashes'] if old else []
+        for i, key in enumerate(new['keys']):
+            j = old_index.pop(key, None)
+            if j is None:
+                added.append(i)
+            elif old_hashes[j] != new['hashes'][i]:
+                modified.append((i, j))
+            else:
+                unchanged += 1
+    return {'added': added, 'removed': sorted(old_index.values()),
+            'modified': modified, 'unchanged': unchanged}
+
+
+def load_snapshot(path):
+    """Read a snapshot, or return None if there is no usable one"""
+
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        # Unreadable, start over from this scrub
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+    return snapshot
+
+
+def save_snapshot(path, customer_name, sheets) -> None:
+    """Write a snapshot, replacing path in one step
+
+    :param path: snapshot file path
+    :param customer_name: organization name from the export
+    :param sheets: dictionary of sheet name:sheet_snapshot()
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.tmp'
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+        json.dump({
+            'version': SNAPSHOT_VERSION,
+            'customer': customer_name,
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'sheets': sheets,
+        }, f, separators=(',', ':'))
+    os.replace(temp_path, path)
+
+
+def _aligned(values, from_columns, to_columns) -> list:
+    """Reorder one text row from from_columns to to_columns"""
+
+    cells = dict(zip(from_columns, values))
+    return [cells.get(col, '') for col in to_columns]
+
+
+def write_delta_workbook(path, previous, sheets, changes) -> None:
+    """Write a summary sheet and, for every sheet that changed, its
+    added, removed and modified rows
+
+    :param path: path of the xlsx file to create
+    :param previous: snapshot the changes are against
+    :param sheets: dictionary of sheet name:sheet_snapshot() of this scrub
+    :param changes: dictionary of sheet name:diff_sheet() result
+    """
+
+    import xlsxwriter
+
+    wb = xlsxwriter.Workbook(path)
+    summary = wb.add_worksheet(SUMMARY_SHEET)
+    summary.write(0, 6, f'Changes since {previous["created"]}')
+    summary.set_column(0, 0, 30)
+    for row_num, (name, change) in enumerate(changes.items(), start=1):
+        summary.write_row(row_num, 0, [
+            name, len(change['added']), len(change['removed']),
+            len(change['modified']), change['unchanged']
+        ])
+    summary.add_table(0, 0, len(changes), 4, {
+        'columns': [{'header': h} for h in
+                    ('Sheet', 'Added', 'Removed', 'Modified', 'Unchanged')]
+    })
+
+    for name, change in changes.items():
+        new = sheets.get(name)
+        old = previous['sheets'].get(name)
+        if not (change['added'] or change['removed'] or change['modified']):
+            continue
+
+        # New columns first, then any the old sheet had
+        columns = list(new['columns']) if new else []
+        if old:
+            columns += [col for col in old['columns'] if col not in columns]
+
+        rows = []
+        for i in change['added']:
+            rows.append(['Added', ''] + _aligned(new['rows'][i],
+                                                 new['columns'], columns))
+        for i, j in change['modified']:
+            new_row = _aligned(new['rows'][i], new['columns'], columns)
+            old_row = _aligned(old['rows'][j], old['columns'], columns)
+            changed = [col for col, a, b in zip(columns, new_row, old_row)
+                       if a != b]
+            rows.append(['Modified', ', '.join(changed)] + new_row)
+        for j in change['removed']:
+            rows.append(['Removed', ''] + _aligned(old['rows'][j],
+                                                   old['columns'], columns))
+
+        headers = CHANGE_COLUMNS + columns
+        sheet = wb.add_worksheet(name)
+        sheet.add_table(0, 0, len(rows), len(headers) - 1, {
+            'columns': [{'header': h} for h in headers]
+        })
+        for row_num, row in enumerate(rows, start=1):
+            sheet.write_row(row_num, 0, row)
+        for i, header in enumerate(headers):
+            longest = max([len(header)] + [len(row[i]) for row in rows])
+            sheet.set_column(i, i, (min(longest, 50) + 2) * 1.2)
+    wb.close()
+
+
+def write_delta(working_dir, customer_name, sheets_dict, rules) -> tuple:
+    """Snapshot the cleaned sheets of a scrub and write the changes
+    since the previous snapshot to a delta workbook. The new snapshot
+    is returned, not saved. Save it with save_snapshot() only once the
+    export has fully succeeded, so a retried export is compared with
+    the same previous snapshot again.
+
+    :param working_dir: directory the export and output are in
+    :param customer_name: organization name from the export
+    :param sheets_dict: dictionary of sheet name:DataFrame
+    :param rules: compiled ScrubRules, for the sort columns rows are
+                    keyed by when a csv has no id
+    :return: tuple of the path of the delta workbook (or None on the
+    first scrub) and the dictionary of sheet snapshots to save
+    """
+
+    sheets = {
+        name: sheet_snapshot(df, rules.sort_keys_for(f'{name}.csv',
+                                                     list(df.columns)))
+        for name, df in sheets_dict.items()
+    }
+    previous = load_snapshot(snapshot_path(working_dir, customer_name))
+
+    output = None
+    if previous is not None:
+        names = list(sheets) + [name for name in previous['sheets']
+                                if name not in sheets]
+        changes = {name: diff_sheet(previous['sheets'].get(name),
+                                    sheets.get(name))
+                   for name in names}
+        output = delta_file(working_dir, customer_name)
+        write_delta_workbook(output, previous, sheets, changes)
+    return output, sheets
@@ -0,0 +1,1671 @@
+"""
+ITG_export_scrub_engine.py
+
+Author: Josh Smith
+
+Purpose: Headless scrub engine for ITG exports. Holds all of the
+processing logic used by the GUI and the command line entry point,
+without importing tkinter. Progress is reported through an optional
+callback that receives a status message string. A callback that also
+has a step(name, done, total, rows) method is told every time a csv or
+the workbook is finished.
+See 'TPG ITG Export Scrubber Specification.rst' for more info.
+"""
+
+# imports
+import os
+from os.path import basename
+import shutil
+import csv
+import io
+import re
+from itertools import chain
+import unicodedata
+from zipfile36 import ZipFile, BadZipFile, ZIP_DEFLATED
+import datetime
+import functools
+import importlib
+from contextlib import contextmanager
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import traceback
+import time
+import json
+import tracemalloc
+from ITG_export_scrub_rules import load_rules
+from ITG_export_scrub_manifest import ManifestSet
+from ITG_export_scrub_archive import open_archive, add_to_archive, \
+    OutputBundle
+from ITG_export_scrub_options import ScrubOptions
+from ITG_export_scrub_cache import HtmlCache
+from ITG_export_scrub_delta import write_delta, save_snapshot, \
+    snapshot_path
+from ITG_export_scrub_errors import FAILURE_NOT_FOUND, FAILURE_PERMISSION, \
+    FAILURE_BAD_ZIP, FAILURE_OS, FAILURE_DEPENDENCY, FAILURE_UNEXPECTED, \
+    FAILURE_TIMEOUT, ExportTimeout, \
+    TRANSIENT_FAILURES, DEFAULT_RETRIES, DEFAULT_RETRY_DELAY, \
+    BatchSummary, retry_delay
+
+# pandas, xlsxwriter and BeautifulSoup take most of the start up time,
+# so they are imported by the functions that use them. Low memory xlsx
+# and csv runs never load pandas, and cells without markup never load
+# the html parser. See warm_up() to load them ahead of time.
+
+
+# Number of distinct raw cells to keep cleaned results for.
+# Exports repeat many values (organization name, Yes/No, Active,
+# short copied notes) so most cells are served from the cache.
+CELL_CACHE_SIZE = 2 ** 16
+
+# Longest raw cell kept in the cache. Longer cells (whole note blocks)
+# are cleaned every time, so the cache holds at most about
+# CELL_CACHE_SIZE * CACHED_CELL_LENGTH * 2 characters (~32 MB) however
+# large the notes are. The persistent html cache still covers them.
+CACHED_CELL_LENGTH = 256
+
+# Widest a column will be set to, in characters
+MAX_COLUMN_WIDTH = 50
+
+# Columns where every value matches are written as Excel numbers or
+# dates. Whole numbers only, up to 15 digits, without leading zeros or
+# -0, so the number shows exactly as the text did. Integer columns get a
+# plain number format, General shows over 11 digits as 1.23457E+14.
+INTEGER_PATTERN = re.compile(r'0|-?[1-9]\d{0,14}')
+INTEGER_FORMAT = '0'
+DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}')
+DATE_FORMAT = 'yyyy-mm-dd'
+
+# Output formats. xlsx is the client deliverable, csv (a zip of
+# UTF-8 csv's) and parquet (a directory of .parquet files, needs
+# pyarrow or fastparquet) skip Excel formatting for internal use.
+OUTPUT_FORMATS = ('xlsx', 'csv', 'parquet')
+
+# Results of one export in a batch
+RESULT_OK = 0
+RESULT_ERROR = 1
+RESULT_SKIPPED = 2
+RESULT_NAMES = {RESULT_OK: 'ok', RESULT_ERROR: 'error',
+                RESULT_SKIPPED: 'skipped'}
+
+# Estimated peak memory per byte of kept csv when every sheet is held
+# in memory, see estimate_memory(). Csv's that compress well repeat
+# their cells, which share one cleaned string, so they cost less.
+# Measured on generated exports of 20,000 rows a sheet.
+MEMORY_PER_CSV_BYTE = 13
+MEMORY_PER_COMPRESSED_BYTE = 60
+
+# Rows read or written between checks of the time limit
+DEADLINE_CHECK_ROWS = 5000
+
+# Dependencies imported on first use, see warm_up()
+HEAVY_MODULES = ('pandas', 'xlsxwriter', 'bs4', 'lxml')
+
+logger = logging.getLogger(__name__)
+
+# Persistent html cache used by clean_cell(), see html_cache_session()
+_html_cache = None
+
+
+class PhaseTimer:
+    """Accumulate wall time spent in each processing phase.
+    Phases used by process_exports: unzip, parse_clean, dataframe,
+    filter, width, xlsx_write (or csv_write/parquet_write) and zip."""
+
+    def __init__(self):
+        self.phases = {}
+        # Set by process_exports once read from the export
+        self.customer_name = None
+        # Set by process_exports to a FAILURE_* class when it fails
+        self.failure = None
+        # Set by process_exports when the memory budget switched the
+        # export to low memory mode
+        self.low_memory_fallback = False
+        # Set by process_exports to the delta workbook (or its zip)
+        # when one is written
+        self.delta_output = None
+        # time.time() the export must finish by, or None
+        self.deadline = None
+
+    def check_deadline(self) -> None:
+        """Raise ExportTimeout once the time limit has run out"""
+
+        if self.deadline is not None and time.time() > self.deadline:
+            raise ExportTimeout('time limit reached')
+
+    def watch_rows(self, rows):
+        """Pass rows through, checking the time limit every
+        DEADLINE_CHECK_ROWS rows. Rows are returned as is without one."""
+
+        if self.deadline is None:
+            return rows
+        return self._watched_rows(rows)
+
+    def _watched_rows(self, rows):
+        for count, row in enumerate(rows, 1):
+            if count % DEADLINE_CHECK_ROWS == 0:
+                self.check_deadline()
+            yield row
+
+    @contextmanager
+    def phase(self, name):
+        """Time the body of a with block and add it to phase name"""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = (self.phases.get(name, 0.0)
+                                 + time.perf_counter() - start)
+
+    @contextmanager
+    def sheet(self, file):
+        """Per sheet statistics are only kept by RunReport"""
+
+        yield None
+
+
+class RunReport(PhaseTimer):
+    """PhaseTimer that also records statistics for every sheet:
+    wall time, rows in and out, html cells, columns in and out and
+    peak memory. Peak memory is traced with tracemalloc, which slows
+    processing, so this is only used when a run report is asked for."""
+
+    def __init__(self):
+        super().__init__()
+        self.sheets = []
+
+    @contextmanager
+    def sheet(self, file):
+        """Collect statistics for one csv in the body of a with block
+
+        :param file: csv file name inside the export
+        :return: context manager giving the statistics dictionary
+        """
+
+        stats = {'file': file, 'rows_in': 0, 'rows_out': 0,
+                 'cells_html': 0, 'columns_in': 0, 'columns_out': 0}
+        # Only trace while the sheet is read, tracing the
+        # workbook write would slow it down for nothing
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats['seconds'] = round(time.perf_counter() - start, 4)
+            stats['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+            if started_tracing:
+                tracemalloc.stop()
+            self.sheets.append(stats)
+
+    @staticmethod
+    def count_rows(rows, stats):
+        """Pass rows through, counting them and the cells that
+        hold html or entities into stats"""
+
+        for row in rows:
+            stats['rows_in'] += 1
+            stats['cells_html'] += sum(1 for cell in row
+                                       if '<' in cell or '&' in cell)
+            yield row
+
+    def record(self, input_zip, result, seconds) -> dict:
+        """Build the run report record of one export
+
+        :param input_zip: path of the export zip
+        :param result: process_exports result, 0 or 1
+        :param seconds: total wall time of the export
+        :return: JSON serializable dictionary
+        """
+
+        return {
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'input_zip': input_zip,
+            'customer_name': self.customer_name,
+            'result': result,
+            'failure': self.failure,
+            'low_memory_fallback': self.low_memory_fallback,
+            'seconds': round(seconds, 4),
+            'phases': {k: round(v, 4) for k, v in self.phases.items()},
+            'sheets': self.sheets,
+            'cell_cache': cell_cache_stats(),
+        }
+
+
+def _no_progress(message) -> None:
+    """Default progress callback. Discard the message."""
+
+
+def _no_step(name, done, total, rows) -> None:
+    """Default progress step. Discard the step."""
+
+
+def log_error(err_file, message) -> None:
+    """Simple function for opening passed txt file
+    and appending message
+
+    :param err_file: txt file
+    :param message: string to append.
+    This function will prepend current date and time
+    """
+
+    with open(err_file, 'a') as f:
+        f.write(f'Error_{datetime.datetime.now()}_{message}\n')
+
+
+def clean_cell(cell) -> str:
+    """Convert any html in a csv cell to plain text and normalize
+    unicode. Results of cells up to CACHED_CELL_LENGTH long are kept
+    in a bounded LRU cache keyed on the raw cell, see
+    cell_cache_stats().
+
+    :param cell: raw csv cell string
+    :return: cleaned cell string
+    """
+
+    if len(cell) > CACHED_CELL_LENGTH:
+        return clean_cell_uncached(cell)
+    return _cached_clean_cell(cell)
+
+
+def clean_cell_uncached(cell) -> str:
+    """clean_cell() without the LRU cache. Cells without '<' or '&'
+    cannot contain markup or entities, so they skip the html parser
+    entirely. Cells with markup are looked up in the persistent html
+    cache, when one is in use.
+
+    :param cell: raw csv cell string
+    :return: cleaned cell string
+    """
+
+    if '<' not in cell and '&' not in cell:
+        return unicodedata.normalize('NFKD', cell)
+
+    # Cleaned by an earlier run or another client's export
+    html_cache = _html_cache
+    if html_cache is not None:
+        cleaned = html_cache.get(cell)
+        if cleaned is not None:
+            return cleaned
+
+    # Detect html in cell and convert if so (parse only once)
+    from bs4 import BeautifulSoup
+    text = cell
+    soup = BeautifulSoup(cell, 'lxml')
+    if soup.find():
+        text = soup.text
+
+    # normalize text
+    cleaned = unicodedata.normalize('NFKD', text)
+    if html_cache is not None:
+        html_cache.put(cell, cleaned)
+    return cleaned
+
+
+_cached_clean_cell = functools.lru_cache(maxsize=CELL_CACHE_SIZE)(
+    clean_cell_uncached)
+
+
+def cell_cache_stats() -> dict:
+    """Return hit/miss counters and size of the clean_cell cache
+    for this process
+
+    :return: dictionary with hits, misses, size and maxsize
+    """
+
+    return _cached_clean_cell.cache_info()._asdict()
+
+
+@contextmanager
+def html_cache_session(path):
+    """Use the persistent html cache at path in clean_cell() for the
+    length of the block, then write out the cells it added
+
+    :param path: SQLite cache file, or None to use no cache
+    :return: context manager yielding the HtmlCache, or None
+    """
+
+    global _html_cache
+    if not path:
+        yield None
+        return
+    _html_cache = HtmlCache(path)
+    try:
+        yield _html_cache
+    finally:
+        html_cache, _html_cache = _html_cache, None
+        html_cache.close()
+        logger.debug(f'html cache: {html_cache.stats()}')
+
+
+def report_log_path(working_dir) -> str:
+    """Return the path of today's JSON-lines run report in working_dir
+
+    :param working_dir: directory the run report is kept in
+    :return: full path to the jsonl file
+    """
+
+    return os.path.join(working_dir, f'ITG_scrubber_report_'
+                                     f'{datetime.date.today()}.jsonl')
+
+
+def output_file(working_dir, customer_name, zip_task,
+                output_format='xlsx') -> str:
+    """Return the path of the output, or its zip if zip_task is 'Yes'.
+    The csv bundle is always a zip.
+
+    :param working_dir: directory the output is written to
+    :param customer_name: customer name read from the export
+    :param zip_task: 'Yes' or 'No' to zip the output
+    :param output_format: one of OUTPUT_FORMATS
+    :return: full path to the output file (or parquet directory)
+    """
+
+    name = f'{customer_name}_export'
+    if output_format != 'xlsx':
+        name += f'_{output_format}'
+    if zip_task == 'Yes' or output_format == 'csv':
+        return os.path.join(working_dir, f'{name}.zip')
+    if output_format == 'parquet':
+        return os.path.join(working_dir, name)
+    return os.path.join(working_dir, f'{name}.xlsx')
+
+
+def remove_output(path) -> None:
+    """Remove an old output file, or parquet directory"""
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def error_log_path(working_dir) -> str:
+    """Return the path of today's error log in working_dir
+
+    :param working_dir: directory the error log is kept in
+    :return: full path to the error txt file
+    """
+
+    return os.path.join(working_dir, f'ITG_scrubber_errors_'
+                                     f'{datetime.date.today()}.txt')
+
+
+def find_exports(targets) -> list:
+    """Expand a list of zip paths and/or directories
+    into a list of zip file paths to process.
+
+    :param targets: iterable of zip file paths or directories.
+                    Directories contribute every zip file directly
+                    inside them.
+    :return: list of zip file paths in the order given
+    """
+
+    zips = []
+    for target in targets:
+        if os.path.isdir(target):
+            for file in sorted(os.listdir(target)):
+                if file.lower().endswith('.zip'):
+                    zips.append(os.path.join(target, file))
+        else:
+            zips.append(target)
+    return zips
+
+
+@contextmanager
+def open_csv(in_zip, file):
+    """Open a csv inside the export zip for streaming.
+    Nothing is extracted to disk.
+
+    :param in_zip: open ZipFile of the export
+    :param file: csv file name inside the export
+    :return: context manager giving a tuple of the header list and
+    a csv.reader over the data rows
+    """
+
+    with in_zip.open(file) as raw_file:
+        csv_file = io.TextIOWrapper(raw_file, encoding='utf-8')
+        # Parse the header row with the csv module too, so quoted
+        # headers holding commas keep the column indexes in line
+        reader = csv.reader(csv_file)
+        headers = next(reader, [])
+        yield headers, reader
+
+
+@functools.lru_cache(maxsize=256)
+def header_index(headers) -> dict:
+    """Map each header name to the index of its first column.
+    Cached per header row, as the exports of a batch share layouts.
+    The returned dictionary is shared, do not change it.
+
+    :param headers: tuple of csv header names
+    :return: dictionary of header name:column index
+    """
+
+    index = {}
+    for i, header in enumerate(headers):
+        index.setdefault(header, i)
+    return index
+
+
+def unique_headers(headers) -> list:
+    """Rename repeated header names the way Excel does for tables,
+    Notes, Notes2, Notes3, so every column of a sheet can be told
+    apart by name (tables and parquet files need that)
+
+    :param headers: list of header names left in a sheet
+    :return: list of unique header names, in the same order
+    """
+
+    taken = set(headers)
+    seen = set()
+    unique = []
+    for header in headers:
+        name = header
+        number = 1
+        while name in seen or (name != header and name in taken):
+            number += 1
+            name = f'{header}{number}'
+        seen.add(name)
+        unique.append(name)
+    return unique
+
+
+def build_sheet(file, headers, working_rows, rules, timer=None):
+    """Filter and clean the rows of one csv into a DataFrame.
+    Drop archived rows (and non Active configurations), empty columns
+    and columns that are always deleted, then sort by the first
+    column if it is a sorter column (or by the csv's sort_by columns).
+    See sort_sheet().
+
+    :param file: csv file name inside the export
+    :param headers: list of csv header names
+    :param working_rows: list of cleaned rows (lists of strings)
+    :param rules: compiled ScrubRules
+    :param timer: optional PhaseTimer
+    :return: pandas DataFrame, or None if no columns are left
+    """
+
+    import pandas as pd
+
+    timer = timer or PhaseTimer()
+
+    # Load the rows into a DataFrame. Short rows are padded
+    # with blank cells
+    with timer.phase('dataframe'):
+        df = pd.DataFrame(working_rows, columns=headers).fillna('')
+    with timer.phase('filter'):
+        return _filter_sheet(file, headers, df, rules)
+
+
+def _filter_sheet(file, headers, df, rules):
+    """Drop filtered rows and deleted/empty columns, then sort.
+    See build_sheet()."""
+
+    import pandas as pd
+
+    # Drop any row with archive set to 'Yes' and any configuration
+    # status in configurations csv other than Active. Columns are
+    # found by position, header names can repeat.
+    index = header_index(tuple(headers))
+    keep_rows = pd.Series(True, index=df.index)
+    if 'archived' in index:
+        keep_rows &= df.iloc[:, index['archived']] != 'Yes'
+    if file == 'configurations.csv' and 'configuration_status' in index:
+        keep_rows &= df.iloc[:, index['configuration_status']] == 'Active'
+    df = df[keep_rows]
+    ids = df.iloc[:, index['id']] if 'id' in index else None
+
+    # Ignore columns to be "deleted" and all blank columns
+    df = df.iloc[:, list(rules.column_plan(file, headers))]
+    df = df.loc[:, ~(df == '').all().to_numpy()]
+    new_headers = unique_headers(list(df.columns))
+    df.columns = new_headers
+
+    if len(new_headers) == 0:
+        return None
+    df = compact_sheet(df)
+
+    # Keep the ITG id of each row as the index, even when the id column
+    # is deleted, to match rows with the last scrub. See write_delta().
+    if ids is not None:
+        df.index = pd.Index(ids.to_numpy(), name='id')
+
+    # Sort any sheets if name column is present, or by the sort_by
+    # columns of the csv in the rules
+    return sort_sheet(df, rules.sort_keys_for(file, new_headers))
+
+
+def sort_rank(column):
+    """Precomputed sort key of one column. Each cell gets the rank of
+    its value among the column's distinct values, so only the distinct
+    values are compared. Text ranks case-insensitively, with case
+    breaking ties. Blank cells rank first, as they did when every
+    column was text.
+
+    :param column: pandas Series of a compacted sheet
+    :return: numpy int64 array of ranks, -1 for missing values
+    """
+
+    import numpy as np
+    import pandas as pd
+
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        codes, values = column.cat.codes.to_numpy(), column.cat.categories
+    else:
+        codes, values = pd.factorize(column)
+    if pd.api.types.is_numeric_dtype(values.dtype) \
+            or pd.api.types.is_datetime64_any_dtype(values.dtype):
+        order = np.argsort(np.asarray(values), kind='stable')
+    else:
+        # One string per value compares faster than a tuple. NUL sorts
+        # before every character, so the case folded text decides first.
+        folded = [value.casefold() + '\0' + value
+                  for value in values.to_numpy(dtype=object)]
+        order = sorted(range(len(folded)), key=folded.__getitem__)
+    ranks = np.empty(len(values), dtype=np.int64)
+    ranks[order] = np.arange(len(values))
+    return np.where(codes < 0, -1, ranks[codes])
+
+
+def _is_sorted(ranks) -> bool:
+    """Check in one pass whether rows are already in order of the
+    sort_rank() arrays in ranks, primary key first"""
+
+    import numpy as np
+
+    # Rows still tied with the next row on every key so far
+    tied = np.ones(len(ranks[0]) - 1, dtype=bool)
+    for rank in ranks:
+        before, after = rank[:-1], rank[1:]
+        if (tied & (before > after)).any():
+            return False
+        tied &= before == after
+    return True
+
+
+def sort_sheet(df, keys):
+    """Stable sort of a sheet by one or more columns, primary first.
+    Rows tied on every key keep their export order, so the same export
+    always gives the same output. A sheet already in order (exports
+    often are) is returned as is, without a copy.
+
+    :param df: pandas DataFrame of a compacted sheet
+    :param keys: sequence of column names, empty for no sort
+    :return: pandas DataFrame
+    """
+
+    import numpy as np
+
+    if not keys or len(df) < 2:
+        return df
+    ranks = [sort_rank(df[key]) for key in keys]
+    if _is_sorted(ranks):
+        return df
+    # lexsort is stable and takes the primary key last
+    return df.iloc[np.lexsort(ranks[::-1])]
+
+
+def compact_column(column):
+    """Store one cleaned text column in a compact, typed form.
+    Whole numbers become Int64 and ISO dates become datetimes, with
+    blank cells as missing values, so they are written as native Excel
+    types. Columns that repeat their values (Yes/No, Active, OS and
+    vendor names) become categories. Anything else stays text.
+
+    :param column: pandas Series of cleaned strings
+    :return: pandas Series
+    """
+
+    import pandas as pd
+
+    values = column[column != '']
+    if len(values) == 0:
+        return column
+    first = values.iat[0]
+    if (INTEGER_PATTERN.fullmatch(first)
+            and values.str.fullmatch(INTEGER_PATTERN).all()):
+        return pd.to_numeric(column.mask(column == '')).astype('Int64')
+    if (DATE_PATTERN.fullmatch(first)
+            and values.str.fullmatch(DATE_PATTERN).all()):
+        try:
+            return pd.to_datetime(column.mask(column == ''),
+                                  format='%Y-%m-%d')
+        except ValueError:
+            # Not a real date (e.g. 2021-02-30), keep the text
+            pass
+    if column.nunique() * 2 <= len(column):
+        return column.astype('category')
+    return column
+
+
+def compact_sheet(df):
+    """Apply compact_column() to every column of a sheet"""
+
+    import pandas as pd
+
+    compacted = pd.concat([compact_column(df.iloc[:, i])
+                           for i in range(df.shape[1])], axis=1)
+    compacted.columns = df.columns
+    return compacted
+
+
+def _cell_values(column):
+    """Values of a compacted column as xlsxwriter takes them, one
+    column at a time instead of a copy of the whole sheet. Missing
+    numbers and dates become None, which is written as a blank cell."""
+
+    import pandas as pd
+
+    if (pd.api.types.is_numeric_dtype(column.dtype)
+            or pd.api.types.is_datetime64_any_dtype(column.dtype)):
+        return column.astype(object).where(column.notna(), None)
+    return column
+
+
+def _column_width(max_length) -> float:
+    """Convert the widest string length of a column to a column width"""
+
+    return (min(max_length, MAX_COLUMN_WIDTH) + 2) * 1.2
+
+
+def column_widths(df) -> list:
+    """Find a readable width for every column of a sheet, based on
+    the widest string in the column (header included), capped at
+    MAX_COLUMN_WIDTH characters
+
+    :param df: pandas DataFrame of one sheet
+    :return: list of column widths in the order of df.columns
+    """
+
+    import pandas as pd
+
+    widths = []
+    for i, col in enumerate(df.columns):
+        max_length = len(str(col))
+        column = df.iloc[:, i]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            # Only the distinct values need measuring
+            column = pd.Series(
+                column.cat.remove_unused_categories().cat.categories
+            )
+        lengths = column.astype('string').str.len()
+        if lengths.notna().any():
+            max_length = max(max_length, int(lengths.max()))
+        widths.append(_column_width(max_length))
+    return widths
+
+
+def write_workbook(wb_file, sheets_dict, timer=None) -> None:
+    """Write every sheet to a new workbook, each formatted as a table
+
+    :param wb_file: path of the xlsx file to create
+    :param sheets_dict: dictionary of sheet name:DataFrame
+    :param timer: optional PhaseTimer
+    """
+
+    import pandas as pd
+    import xlsxwriter
+
+    timer = timer or PhaseTimer()
+    wb = xlsxwriter.Workbook(wb_file, {'default_date_format': DATE_FORMAT})
+    integer_format = wb.add_format({'num_format': INTEGER_FORMAT})
+    for key, value in sheets_dict.items():
+        timer.check_deadline()
+        with timer.phase('width'):
+            widths = column_widths(value)
+        with timer.phase('xlsx_write'):
+            sheet = wb.add_worksheet(key)
+            sheet.add_table(0, 0, value.shape[0], value.shape[1] - 1, {
+                'columns': [{'header': col} for col in value.columns]
+            })
+            # Write a column at a time, without a list of lists copy
+            for i in range(value.shape[1]):
+                sheet.write_column(1, i, _cell_values(value.iloc[:, i]))
+            # Set uniform column width in the same write pass, and the
+            # number format of integer columns
+            for i, width in enumerate(widths):
+                is_integer = pd.api.types.is_integer_dtype(
+                    value.dtypes.iloc[i])
+                sheet.set_column(i, i, width,
+                                 integer_format if is_integer else None)
+    with timer.phase('xlsx_write'):
+        wb.close()
+
+
+def write_csv_bundle(out_file, sheets_dict, timer=None) -> None:
+    """Write every sheet as a UTF-8 csv into a new zip
+
+    :param out_file: path of the zip file to create
+    :param sheets_dict: dictionary of sheet name:DataFrame
+    :param timer: optional PhaseTimer
+    """
+
+    timer = timer or PhaseTimer()
+    with timer.phase('csv_write'):
+        with ZipFile(out_file, 'w', ZIP_DEFLATED) as out_zip:
+            for key, value in sheets_dict.items():
+                timer.check_deadline()
+                # Closing the wrapper closes the zip member too
+                with io.TextIOWrapper(out_zip.open(f'{key}.csv', 'w'),
+                                      encoding='utf-8',
+                                      newline='') as csv_file:
+                    value.to_csv(csv_file, index=False)
+
+
+def write_parquet(out_dir, sheets_dict, timer=None) -> None:
+    """Write every sheet as a parquet file into a new directory
+
+    :param out_dir: path of the directory to create
+    :param sheets_dict: dictionary of sheet name:DataFrame
+    :param timer: optional PhaseTimer
+    """
+
+    timer = timer or PhaseTimer()
+    with timer.phase('parquet_write'):
+        os.makedirs(out_dir)
+        for key, value in sheets_dict.items():
+            timer.check_deadline()
+            value.to_parquet(os.path.join(out_dir, f'{key}.parquet'),
+                             index=False)
+
+
+def iter_kept_rows(file, headers, rows):
+    """Clean and filter streamed csv rows one at a time.
+    Rows are padded or trimmed to the header width, and archived rows
+    (and non Active configurations) are skipped. Cells go through
+    clean_cell(), whose cache is capped by CACHED_CELL_LENGTH, so low
+    memory mode stays bounded by row width plus a constant while both
+    of its passes share cleaned cells.
+
+    :param file: csv file name inside the export
+    :param headers: list of csv header names
+    :param rows: iterable of raw csv rows
+    :return: generator of cleaned rows
+    """
+
+    index = header_index(tuple(headers))
+    archive_index = index.get('archived')
+    configuration_status_index = None
+    if file == 'configurations.csv':
+        configuration_status_index = index.get('configuration_status')
+
+    width = len(headers)
+    for row in rows:
+        row = [clean_cell(cell) for cell in row[:width]]
+        if len(row) < width:
+            row.extend([''] * (width - len(row)))
+        if archive_index is not None and row[archive_index] == 'Yes':
+            continue
+        if (configuration_status_index is not None
+                and row[configuration_status_index] != 'Active'):
+            continue
+        yield row
+
+
+def scan_sheet(file, headers, rows, rules):
+    """First pass of low memory mode. Stream the rows of one csv to
+    find the columns to keep, their widths and the kept row count,
+    without holding the rows.
+
+    :param file: csv file name inside the export
+    :param headers: list of csv header names
+    :param rows: iterable of raw csv rows
+    :param rules: compiled ScrubRules
+    :return: dictionary describing the sheet, or None if no columns
+    are left
+    """
+
+    non_empty = [False] * len(headers)
+    max_lengths = [len(h) for h in headers]
+    row_count = 0
+    for row in iter_kept_rows(file, headers, rows):
+        row_count += 1
+        for i, cell in enumerate(row):
+            if cell != '':
+                non_empty[i] = True
+                if len(cell) > max_lengths[i]:
+                    max_lengths[i] = len(cell)
+
+    # Ignore columns to be "deleted" and all blank columns
+    columns = [i for i in rules.column_plan(file, headers) if non_empty[i]]
+    if len(columns) == 0:
+        return None
+    return {'file': file,
+            'columns': columns,
+            'headers': unique_headers([headers[i] for i in columns]),
+            'widths': [_column_width(max_lengths[i]) for i in columns],
+            'rows': row_count,
+            }
+
+
+def write_streamed_workbook(wb_file, input_zip, sheets_dict,
+                            timer=None) -> None:
+    """Second pass of low memory mode. Stream the kept rows of every
+    sheet from the export zip straight into a constant_memory workbook,
+    so memory use is bounded by row width, not row count.
+    xlsxwriter cannot add tables in constant_memory mode, so each sheet
+    gets a frozen header row with an autofilter instead, and rows are
+    left in export order (sorting would need every row in memory).
+
+    :param wb_file: path of the xlsx file to create
+    :param input_zip: path of the export zip
+    :param sheets_dict: dictionary of sheet name:scan_sheet result
+    :param timer: optional PhaseTimer holding the time limit
+    """
+
+    import xlsxwriter
+
+    timer = timer or PhaseTimer()
+    wb = xlsxwriter.Workbook(wb_file, {'constant_memory': True})
+    header_format = wb.add_format({'bold': True})
+    with ZipFile(input_zip, 'r') as in_zip:
+        for key, plan in sheets_dict.items():
+            sheet = wb.add_worksheet(key)
+            for i, width in enumerate(plan['widths']):
+                sheet.set_column(i, i, width)
+            sheet.write_row(0, 0, plan['headers'], header_format)
+            rows = timer.watch_rows(iter_planned_rows(in_zip, plan))
+            for row_num, row in enumerate(rows, start=1):
+                sheet.write_row(row_num, 0, row)
+            sheet.autofilter(0, 0, plan['rows'], len(plan['columns']) - 1)
+            sheet.freeze_panes(1, 0)
+    wb.close()
+
+
+def iter_planned_rows(in_zip, plan):
+    """Stream the kept cells of one planned sheet from the export
+
+    :param in_zip: open ZipFile of the export
+    :param plan: scan_sheet result
+    :return: generator of rows holding only the planned columns
+    """
+
+    with open_csv(in_zip, plan['file']) as (headers, reader):
+        for row in iter_kept_rows(plan['file'], headers, reader):
+            yield [row[i] for i in plan['columns']]
+
+
+def write_streamed_csv_bundle(out_file, input_zip, sheets_dict,
+                              timer=None) -> None:
+    """Second pass of low memory mode for the csv format. Stream the
+    kept rows of every sheet from the export zip into a zip of csv's.
+
+    :param out_file: path of the zip file to create
+    :param input_zip: path of the export zip
+    :param sheets_dict: dictionary of sheet name:scan_sheet result
+    :param timer: optional PhaseTimer holding the time limit
+    """
+
+    timer = timer or PhaseTimer()
+    with ZipFile(input_zip, 'r') as in_zip, \
+            ZipFile(out_file, 'w', ZIP_DEFLATED) as out_zip:
+        for key, plan in sheets_dict.items():
+            with io.TextIOWrapper(out_zip.open(f'{key}.csv', 'w'),
+                                  encoding='utf-8',
+                                  newline='') as csv_file:
+                writer = csv.writer(csv_file)
+                writer.writerow(plan['headers'])
+                writer.writerows(
+                    timer.watch_rows(iter_planned_rows(in_zip, plan)))
+
+
+def write_streamed_parquet(out_dir, input_zip, sheets_dict,
+                           timer=None) -> None:
+    """Second pass of low memory mode for the parquet format. Only one
+    sheet is held in memory at a time, a parquet file is written whole.
+
+    :param out_dir: path of the directory to create
+    :param input_zip: path of the export zip
+    :param sheets_dict: dictionary of sheet name:scan_sheet result
+    :param timer: optional PhaseTimer holding the time limit
+    """
+
+    import pandas as pd
+
+    timer = timer or PhaseTimer()
+    os.makedirs(out_dir)
+    with ZipFile(input_zip, 'r') as in_zip:
+        for key, plan in sheets_dict.items():
+            rows = timer.watch_rows(iter_planned_rows(in_zip, plan))
+            df = pd.DataFrame(list(rows),
+                              columns=plan['headers'])
+            df.to_parquet(os.path.join(out_dir, f'{key}.parquet'),
+                          index=False)
+
+
+def estimate_memory(in_zip, input_files) -> int:
+    """Estimate the peak memory of holding every kept csv of an export
+    as cleaned sheets, from the sizes recorded in the zip, before any
+    of it is read
+
+    :param in_zip: open ZipFile of the export
+    :param input_files: csv file names that will be read
+    :return: estimated bytes
+    """
+
+    estimate = 0
+    for file in input_files:
+        info = in_zip.getinfo(file)
+        estimate += min(info.file_size * MEMORY_PER_CSV_BYTE,
+                        info.compress_size * MEMORY_PER_COMPRESSED_BYTE)
+    return estimate
+
+
+def _read_sheet(in_zip, file, rules, timer, stats, low_memory, progress):
+    """Read, clean and filter one csv of an export
+
+    :param in_zip: open ZipFile of the export
+    :param file: csv file name inside the export
+    :param rules: compiled ScrubRules
+    :param timer: PhaseTimer
+    :param stats: per sheet statistics dictionary, or None
+    :param low_memory: plan the sheet with scan_sheet() instead
+                    of building a DataFrame
+    :param progress: callable taking a status message string
+    :return: tuple of customer name and DataFrame (or sheet plan,
+    None if no columns are left), or None if the csv has no data
+    """
+
+    with open_csv(in_zip, file) as (headers, reader):
+        first_row = next(reader, None)
+        if first_row is None:
+            # No data rows, so every column is empty
+            return None
+
+        # Pull customer name from column B
+        customer_name = first_row[1]
+        progress(f'Processing {customer_name} ...')
+
+        rows = timer.watch_rows(chain([first_row], reader))
+        if stats is not None:
+            stats['columns_in'] = len(headers)
+            rows = RunReport.count_rows(rows, stats)
+        with timer.phase('parse_clean'):
+            if low_memory:
+                # First pass only, rows are streamed
+                # again when the workbook is written
+                sheet = scan_sheet(file, headers, rows, rules)
+            else:
+                # Continue with unpacking current csv
+                # to list of lists
+                working_rows = [[clean_cell(cell) for cell in row]
+                                for row in rows]
+    if not low_memory:
+        sheet = build_sheet(file, headers, working_rows, rules, timer)
+
+    if stats is not None and sheet is not None:
+        if low_memory:
+            stats['rows_out'] = sheet['rows']
+            stats['columns_out'] = len(sheet['columns'])
+        else:
+            stats['rows_out'], stats['columns_out'] = sheet.shape
+    return customer_name, sheet
+
+
+def process_exports(input_zip, options=None, progress=None, rules=None,
+                    timer=None) -> int:
+    """Process one export, optionally writing a run report and
+    a cProfile dump next to the workbook. See _process_export().
+
+    :param input_zip: any zip file. Non ITG exports will be opened,
+                    and ignored once contents are detected as invalid.
+    :param options: ScrubOptions, defaults to ScrubOptions()
+    :param progress: optional callable taking a status message string.
+    :param rules: compiled ScrubRules, defaults to the rules file
+                    shipped with the scrubber.
+    :param timer: optional PhaseTimer to collect time per phase.
+    :return: Integer 0 or 1. 0 means no error occurred.
+    1 means error log is present.
+    """
+
+    options = options or ScrubOptions()
+    report = options.report
+    if not report and not options.profile:
+        with html_cache_session(options.html_cache):
+            return _process_export(input_zip, options, progress, rules,
+                                   timer)
+
+    input_zip = os.path.abspath(input_zip)
+    working_dir = os.path.dirname(input_zip)
+    if report and not isinstance(timer, RunReport):
+        timer = RunReport()
+    profiler = None
+    if options.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+
+    result = 1
+    start = time.perf_counter()
+    try:
+        with html_cache_session(options.html_cache):
+            if profiler:
+                result = profiler.runcall(_process_export, input_zip,
+                                          options, progress, rules, timer)
+            else:
+                result = _process_export(input_zip, options, progress,
+                                         rules, timer)
+    finally:
+        seconds = time.perf_counter() - start
+        if profiler:
+            profiler.dump_stats(os.path.join(
+                working_dir,
+                f'{os.path.splitext(basename(input_zip))[0]}_profile.prof'
+            ))
+        if report:
+            with open(report_log_path(working_dir), 'a',
+                      encoding='utf-8') as f:
+                f.write(json.dumps(timer.record(input_zip, result,
+                                                seconds)) + '\n')
+    return result
+
+
+def _read_sheets(in_zip, input_files, rules, timer, low_memory, progress):
+    """Read every csv one after another in this process
+
+    :return: generator of (file, _read_sheet() result) tuples
+    """
+
+    for file in input_files:
+        timer.check_deadline()
+        with timer.sheet(file) as stats:
+            result = _read_sheet(in_zip, file, rules, timer, stats,
+                                 low_memory, progress)
+        yield file, result
+
+
+def _scrub_sheet(input_zip, file, rules, low_memory, report,
+                 html_cache=None, deadline=None) -> tuple:
+    """Sheet worker. Read, clean and filter one csv of an export in
+    a worker process, opening the zip (and the html cache) on its own.
+
+    :return: tuple of the _read_sheet() result, the worker's phase
+    times and its per sheet statistics (empty without report)
+    """
+
+    timer = RunReport() if report else PhaseTimer()
+    timer.deadline = deadline
+    with html_cache_session(html_cache), ZipFile(input_zip, 'r') as in_zip:
+        with timer.sheet(file) as stats:
+            result = _read_sheet(in_zip, file, rules, timer, stats,
+                                 low_memory, _no_progress)
+    return result, timer.phases, getattr(timer, 'sheets', [])
+
+
+def _read_sheets_parallel(input_zip, input_files, rules, timer,
+                          low_memory, workers, progress, html_cache=None):
+    """Read every csv at the same time in a process pool. The html
+    stripping and unicode normalization are CPU bound, so each csv gets
+    its own process. Phase times from the workers are added up, so they
+    count CPU time across workers rather than wall time.
+
+    :return: generator of (file, _read_sheet() result) tuples,
+    in input_files order
+    """
+
+    report = isinstance(timer, RunReport)
+    with ProcessPoolExecutor(
+            max_workers=min(workers, len(input_files))) as executor:
+        futures = [executor.submit(_scrub_sheet, input_zip, file, rules,
+                                   low_memory, report, html_cache,
+                                   timer.deadline)
+                   for file in input_files]
+        for file, future in zip(input_files, futures):
+            result, phases, sheets = future.result()
+            for name, seconds in phases.items():
+                timer.phases[name] = timer.phases.get(name, 0.0) + seconds
+            if report:
+                timer.sheets.extend(sheets)
+            if result is not None:
+                progress(f'Processing {result[0]} ...')
+            yield file, result
+
+
+def _process_export(input_zip, options, progress=None, rules=None,
+                    timer=None) -> int:
+    """Main processing function. Take a TPG ITG export, read it,
+    ignore unneeded data, clean left over csv's of empty columns,
+    and make it readable
+
+    :param input_zip: any zip file. Non ITG exports will be opened,
+                    and ignored once contents are detected as invalid.
+    :param options: ScrubOptions. In low memory mode each csv is
+                    streamed twice, see write_streamed_workbook(). An
+                    export estimated to need more than the memory
+                    budget falls back to it, see estimate_memory().
+                    The html cache is opened by each sheet worker, the
+                    caller opens it for this process, see
+                    process_exports(). The delta needs full sheets, so
+                    it is skipped in low memory mode.
+    :param progress: optional callable taking a status message string.
+    :param rules: compiled ScrubRules, defaults to the rules file
+                    shipped with the scrubber.
+    :param timer: optional PhaseTimer to collect time per phase.
+    :return: Integer 0 or 1. 0 means no error occurred.
+    1 means error log is present.
+    """
+
+    progress = progress or _no_progress
+    step = getattr(progress, 'step', _no_step)
+    rules = rules or load_rules()
+    timer = timer or PhaseTimer()
+    low_memory = options.low_memory
+    output_format = options.output_format
+    time_limit = options.time_limit
+    if time_limit:
+        timer.deadline = time.time() + time_limit
+
+    # Prep the processing paths
+    input_zip = os.path.abspath(input_zip)
+    working_dir = os.path.dirname(input_zip)
+    error_log = error_log_path(working_dir)
+
+    # Dictionary to contain all customer sheets:dataframe
+    # (or sheet plans in low memory mode)
+    sheets_dict = {}
+    customer_name = None
+
+    # Stream every kept csv straight out of the zip.
+    # Nothing is extracted to disk.
+    try:
+        with timer.phase('unzip'):
+            in_zip = ZipFile(input_zip, 'r')
+        with in_zip:
+            # Sheets follow the order of keep_csv in the rules
+            members = set(in_zip.namelist())
+            input_files = [f for f in rules.keep_csv if f in members]
+
+            # If Backup-managed is present, ignore backup
+            if 'backups-managed.csv' in input_files:
+                input_files = [f for f in input_files if f != 'backup.csv']
+
+            # One step per csv, and one for writing the workbook
+            steps = len(input_files) + 1
+
+            # Stream exports too big to hold in memory
+            memory_budget = options.memory_budget
+            if memory_budget and not low_memory:
+                estimate = estimate_memory(in_zip, input_files)
+                if estimate > memory_budget:
+                    progress(f'{basename(input_zip)} needs about '
+                             f'{estimate / 2 ** 20:.1f} MB, over the memory '
+                             f'budget of {memory_budget / 2 ** 20:.1f} MB. '
+                             f'Using low memory mode.')
+                    low_memory = timer.low_memory_fallback = True
+
+            # Iterate through every remaining csv,
+            # and make changes in memory. Results come back in
+            # input_files order either way.
+            if options.sheet_workers > 1 and len(input_files) > 1:
+                read_results = _read_sheets_parallel(
+                    input_zip, input_files, rules, timer, low_memory,
+                    options.sheet_workers, progress, options.html_cache
+                )
+            else:
+                read_results = _read_sheets(in_zip, input_files, rules,
+                                            timer, low_memory, progress)
+            for done, (file, result) in enumerate(read_results, 1):
+                if result is None:
+                    step(file, done, steps, 0)
+                    continue
+
+                # From the first csv with data, keep the customer name
+                if customer_name is None:
+                    customer_name = timer.customer_name = result[0]
+                sheet = result[1]
+                if sheet is None:
+                    step(file, done, steps, 0)
+                    continue
+                sheets_dict.update({file.split('.')[0]: sheet})
+                step(file, done, steps,
+                     sheet['rows'] if low_memory else len(sheet))
+    except ExportTimeout:
+        log_error(error_log, f'{input_zip} was stopped after reaching the '
+                             f'time limit of {time_limit} seconds '
+                             f'while reading.'
+                             f'\n\n'
+                  )
+        timer.failure = FAILURE_TIMEOUT
+        return 1
+    except FileNotFoundError:
+        log_error(error_log, f'{input_zip} not found. '
+                             f'More Info: {traceback.format_exc()}'
+                             f'\n\n'
+                  )
+        timer.failure = FAILURE_NOT_FOUND
+        return 1
+    except PermissionError:
+        log_error(error_log, f'{input_zip} '
+                             f'permission denied.'
+                             f' Try Running again as admin. '
+                             f'More Info: {traceback.format_exc()}'
+                             f'\n\n'
+                  )
+        timer.failure = FAILURE_PERMISSION
+        return 1
+    except BadZipFile:
+        log_error(error_log, f'{input_zip}'
+                             f' may be corrupt. '
+                             f'More Info: {traceback.format_exc()}'
+                             f'\n\n'
+                  )
+        timer.failure = FAILURE_BAD_ZIP
+        return 1
+    except OSError:
+        log_error(error_log, f'{input_zip} '
+                             f'caused an OS error. '
+                             f' Drive may be full or '
+                             f'path is no longer valid. '
+                             f'More Info: {traceback.format_exc()}'
+                             f'\n\n'
+                  )
+        timer.failure = FAILURE_OS
+        return 1
+
+    # Check if the zip is a valid export (no kept csv had data)
+    if customer_name is None:
+        progress(f'{input_zip} is not a valid ITG export')
+        return 0
+
+    # Populate Workbook (or csv's/parquet files) with all sheets
+    wb_file = output_file(working_dir, customer_name, 'No', output_format)
+    if os.path.exists(wb_file):
+        try:
+            remove_output(wb_file)
+        except PermissionError:
+            log_error(error_log, f'Attempted '
+                                 f'deleting old {wb_file}, '
+                                 f' but permission denied.'
+                                 f' Try running again as admin. '
+                                 f'More Info: {traceback.format_exc()}'
+                                 f'\n\n'
+                      )
+            timer.failure = FAILURE_PERMISSION
+            return 1
+    try:
+        if output_format == 'csv':
+            if low_memory:
+                with timer.phase('csv_write'):
+                    write_streamed_csv_bundle(wb_file, input_zip,
+                                              sheets_dict, timer)
+            else:
+                write_csv_bundle(wb_file, sheets_dict, timer)
+        elif output_format == 'parquet':
+            if low_memory:
+                with timer.phase('parquet_write'):
+                    write_streamed_parquet(wb_file, input_zip,
+                                           sheets_dict, timer)
+            else:
+                write_parquet(wb_file, sheets_dict, timer)
+        elif low_memory:
+            with timer.phase('xlsx_write'):
+                write_streamed_workbook(wb_file, input_zip, sheets_dict,
+                                        timer)
+        else:
+            write_workbook(wb_file, sheets_dict, timer)
+    except ExportTimeout:
+        # Leave no half written output behind
+        if os.path.exists(wb_file):
+            remove_output(wb_file)
+        log_error(error_log, f'{input_zip} was stopped after reaching the '
+                             f'time limit of {time_limit} seconds '
+                             f'while writing {basename(wb_file)}.'
+                             f'\n\n'
+                  )
+        timer.failure = FAILURE_TIMEOUT
+        return 1
+    except ImportError as err:
+        # Leave no empty parquet directory behind
+        if os.path.exists(wb_file):
+            remove_output(wb_file)
+        log_error(error_log, f'Writing {wb_file} needs a package that is '
+                             f'not installed ({err}). Parquet needs '
+                             f'pyarrow or fastparquet. '
+                             f'More Info: {traceback.format_exc()}'
+                             f'\n\n'
+                  )
+        timer.failure = FAILURE_DEPENDENCY
+        return 1
+
+    # Report what changed since the last scrub of this client
+    changes_file = None
+    snapshot = None
+    if options.delta and low_memory:
+        progress('Changes since the last scrub are not reported in '
+                 'low memory mode')
+    elif options.delta:
+        try:
+            with timer.phase('delta'):
+                changes_file, snapshot = write_delta(
+                    working_dir, customer_name, sheets_dict, rules)
+        except OSError as err:
+            log_error(error_log, f'Writing the changes of {customer_name} '
+                                 f'since the last scrub failed. '
+                                 f'More Info: {traceback.format_exc()}'
+                                 f'\n\n'
+                      )
+            timer.failure = (FAILURE_PERMISSION
+                             if isinstance(err, PermissionError)
+                             else FAILURE_OS)
+            return 1
+        if changes_file:
+            progress(f'Changes since the last scrub written to '
+                     f'{basename(changes_file)}')
+        else:
+            progress(f'First scrub of {customer_name} is kept as a '
+                     f'snapshot, changes are reported from the next scrub')
+    step(basename(wb_file), steps, steps, 0)
+
+    # Delete or keep unzipped export
+    if options.post_task == 'Delete':
+        try:
+            os.remove(input_zip)
+        except PermissionError:
+            log_error(error_log, f'Attempted '
+                                 f'deleting {input_zip}, '
+                                 f' but permission denied.'
+                                 f' Try running again as admin. '
+                                 f'More Info: {traceback.format_exc()}'
+                                 f'\n\n'
+                      )
+            timer.failure = FAILURE_PERMISSION
+            return 1
+
+    progress(f'Processing of {customer_name} complete.')
+    logger.debug(f'{customer_name} cell cache: {cell_cache_stats()}')
+
+    # To zip or not to zip output file (needs to be zipped for email).
+    # The csv bundle is already a zip.
+    if options.zip_task == 'Yes' and output_format != 'csv':
+        out_zip = output_file(working_dir, customer_name, 'Yes',
+                              output_format)
+        if os.path.exists(out_zip):
+            try:
+                os.remove(out_zip)
+            except PermissionError:
+                log_error(error_log, f'Attempted '
+                                     f'deleting {input_zip}, '
+                                     f' but permission denied.'
+                                     f' Try running again as admin. '
+                                     f'More Info: '
+                                     f'{traceback.format_exc()}'
+                                     f'\n\n'
+                          )
+                timer.failure = FAILURE_PERMISSION
+                return 1
+        with timer.phase('zip'):
+            with open_archive(out_zip, options.compression) as f:
+                add_to_archive(f, wb_file)
+        try:
+            remove_output(wb_file)
+        except PermissionError:
+            log_error(error_log, f'Attempted '
+                                 f'deleting {wb_file} '
+                                 f'as it has been zipped, '
+                                 f' but permission denied.'
+                                 f' Try running again as admin. '
+                                 f'More Info: {traceback.format_exc()}'
+                                 f'\n\n'
+                      )
+
+    # The delta workbook is zipped for email like the output
+    if changes_file and options.zip_task == 'Yes':
+        delta_zip = f'{os.path.splitext(changes_file)[0]}.zip'
+        with timer.phase('zip'):
+            with open_archive(delta_zip, options.compression) as f:
+                add_to_archive(f, changes_file)
+        try:
+            os.remove(changes_file)
+        except PermissionError:
+            log_error(error_log, f'Attempted '
+                                 f'deleting {changes_file} '
+                                 f'as it has been zipped, '
+                                 f' but permission denied.'
+                                 f' Try running again as admin. '
+                                 f'More Info: {traceback.format_exc()}'
+                                 f'\n\n'
+                      )
+        changes_file = delta_zip
+    timer.delta_output = changes_file
+
+    # Keep the new snapshot only once the export has succeeded, so an
+    # export that failed and is retried is compared with the previous
+    # snapshot again and reports the same changes
+    if snapshot is not None:
+        try:
+            save_snapshot(snapshot_path(working_dir, customer_name),
+                          customer_name, snapshot)
+        except OSError as err:
+            log_error(error_log, f'Saving the snapshot of {customer_name} '
+                                 f'failed. '
+                                 f'More Info: {traceback.format_exc()}'
+                                 f'\n\n'
+                      )
+            timer.failure = (FAILURE_PERMISSION
+                             if isinstance(err, PermissionError)
+                             else FAILURE_OS)
+            return 1
+    return 0
+
+
+def warm_up() -> float:
+    """Import every dependency the engine loads on first use, so a
+    long running process pays for it once, before the first export
+
+    :return: seconds spent importing
+    """
+
+    start = time.perf_counter()
+    for module in HEAVY_MODULES:
+        importlib.import_module(module)
+    return time.perf_counter() - start
+
+
+def default_workers() -> int:
+    """Return the default number of worker processes for a batch"""
+
+    return os.cpu_count() or 1
+
+
+def scrub_export(input_zip, options=None, progress=None,
+                 rules=None) -> tuple:
+    """Batch entry point. Run process_exports on one export and also
+    return the output file written, for the batch manifest, why it
+    failed, for retries and the batch summary, and the delta workbook
+    written, for the bundle.
+
+    :return: tuple of result (0 or 1), output file path (or None
+    if no output was written), failure class (or None) and delta
+    workbook or zip path (or None)
+    """
+
+    options = options or ScrubOptions()
+    timer = RunReport() if options.report else PhaseTimer()
+    result = process_exports(input_zip, options, progress, rules, timer)
+    output = None
+    if result == RESULT_OK and timer.customer_name is not None:
+        output = output_file(os.path.dirname(os.path.abspath(input_zip)),
+                             timer.customer_name, options.zip_task,
+                             options.output_format)
+    return result, output, timer.failure, timer.delta_output
+
+
+def unexpected_failure(input_zip) -> tuple:
+    """Write an unexpected exception while scrubbing input_zip to
+    the error log of the export's directory. Call from an except block.
+
+    :return: scrub_export() style result tuple
+    """
+
+    input_zip = os.path.abspath(input_zip)
+    log_error(error_log_path(os.path.dirname(input_zip)),
+              f'{input_zip} failed unexpectedly. '
+              f'More Info: {traceback.format_exc()}'
+              f'\n\n'
+              )
+    return RESULT_ERROR, None, FAILURE_UNEXPECTED, None
+
+
+def collect_result(input_zip, future) -> tuple:
+    """Return the result of a finished scrub_export future.
+    An unexpected exception in the worker is written to the error log
+    of the export's directory and counted as an error.
+
+    :param input_zip: zip file path the future was submitted for
+    :param future: finished concurrent.futures.Future
+    :return: scrub_export() result tuple. A result of 1 means error
+    log is present.
+    """
+
+    try:
+        return future.result()
+    except Exception:
+        return unexpected_failure(input_zip)
+
+
+def batch_manifests(rules, options) -> ManifestSet:
+    """Return the manifests used to skip unchanged exports, keyed on
+    the rules and the options that change the output
+
+    :param rules: compiled ScrubRules
+    :param options: ScrubOptions of the batch
+    """
+
+    return ManifestSet(rules.key, options.manifest_options())
+
+
+def _scrub_all(todo, options, workers, progress, rules):
+    """Scrub every zip in todo, in this process or in a process pool.
+    An exception scrubbing one zip is logged and does not stop the rest.
+
+    :return: generator of (zip, scrub_export() result) tuples, in the
+    order the zips finish
+    """
+
+    if workers <= 1 or len(todo) <= 1:
+        # A lone export gets the workers for its csv's
+        single = options.replace(
+            sheet_workers=workers if len(todo) == 1 else 1)
+        for input_zip in todo:
+            progress(f'Processing {basename(input_zip)} ...')
+            try:
+                outcome = scrub_export(input_zip, single, progress, rules)
+            except Exception:
+                outcome = unexpected_failure(input_zip)
+            yield input_zip, outcome
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(todo))) as executor:
+        futures = {executor.submit(scrub_export, input_zip, options,
+                                   rules=rules): input_zip
+                   for input_zip in todo}
+        for future in as_completed(futures):
+            yield futures[future], collect_result(futures[future], future)
+
+
+def run_batch(targets, options=None, progress=None, workers=1,
+              rules=None, force=False, bundle=None,
+              retries=DEFAULT_RETRIES, retry_wait=DEFAULT_RETRY_DELAY,
+              summary=None) -> dict:
+    """Process every export found in targets. With more than one
+    worker, each zip is sent to its own worker process. Exports that
+    fail for a transient reason (permission denied or an OS error,
+    e.g. a zip locked on a share) are retried with backoff.
+
+    :param targets: iterable of zip file paths or directories
+    :param options: ScrubOptions of every export in the batch. The
+                    memory budget applies to each export, and every
+                    worker process scrubs its own export, so allow for
+                    workers times the budget.
+    :param progress: optional callable taking a status message string.
+    :param workers: number of worker processes. 1 runs every export
+                    in this process. When only one export needs
+                    scrubbing, its csv's are read by this many
+                    processes instead.
+    :param rules: compiled ScrubRules, loaded once and reused
+                    for every export in the batch.
+    :param force: scrub every export, even when the manifest in its
+                    directory shows the output is up to date
+    :param bundle: optional path of one zip to stream the output of
+                    every export in the batch into, skipped ones too.
+    :param retries: times a transient failure is retried
+    :param retry_wait: seconds to wait before the first retry,
+                    doubled on every further retry
+    :param summary: optional path to write a JSON batch summary to,
+                    with the status, failure class and attempts
+                    of every export
+    :return: dictionary of zip file path:result, where result is
+    RESULT_OK (0), RESULT_ERROR (1, error log is present)
+    or RESULT_SKIPPED (2, output already up to date).
+    """
+
+    options = options or ScrubOptions()
+    progress = progress or _no_progress
+    rules = rules or load_rules()
+    zips = find_exports(targets)
+    manifests = batch_manifests(rules, options)
+    results = {}
+    batch_summary = BatchSummary()
+    bundle_zip = OutputBundle(bundle, options.compression) if bundle \
+        else None
+
+    # Skip exports whose output is already up to date
+    todo = []
+    for input_zip in zips:
+        if not force and manifests.is_current(input_zip):
+            results[input_zip] = RESULT_SKIPPED
+            output = manifests.output(input_zip)
+            batch_summary.record(input_zip, 'skipped', output)
+            progress(f'Skipped {basename(input_zip)}, '
+                     f'output is up to date')
+            if bundle_zip:
+                bundle_zip.add(output)
+        else:
+            todo.append(input_zip)
+
+    attempts = dict.fromkeys(todo, 0)
+    retry_round = 0
+    try:
+        while todo:
+            retry = []
+            for input_zip, (result, output, failure, changes) in _scrub_all(
+                    todo, options, workers, progress, rules):
+                attempts[input_zip] += 1
+                if (failure in TRANSIENT_FAILURES
+                        and attempts[input_zip] <= retries):
+                    progress(f'{basename(input_zip)} failed ({failure}), '
+                             f'it will be retried')
+                    retry.append(input_zip)
+                    continue
+
+                results[input_zip] = result
+                batch_summary.record(input_zip, RESULT_NAMES[result], output,
+                                     failure, attempts[input_zip])
+                manifests.record(input_zip, output)
+                if bundle_zip and output:
+                    bundle_zip.add(output)
+                if bundle_zip and changes:
+                    bundle_zip.add(changes)
+                progress(f'Finished {basename(input_zip)} '
+                         f'({len(results)} of {len(zips)})')
+
+            if retry:
+                delay = retry_delay(retry_round, retry_wait)
+                progress(f'Retrying {len(retry)} export(s) in '
+                         f'{delay:g} seconds ...')
+                time.sleep(delay)
+                retry_round += 1
+            todo = retry
+    finally:
+        manifests.save()
+        if bundle_zip:
+            bundle_zip.close()
+            progress(f'Bundled {len(bundle_zip.names)} output(s) '
+                     f'into {bundle}')
+        if summary:
+            batch_summary.save(summary)
+
+    # Keep results in the same order as the inputs
+    return {input_zip: results[input_zip] for input_zip in zips}
@@ -0,0 +1,122 @@
+"""
+ITG_export_scrub_errors.py
+
+Author: Josh Smith
+
+Purpose: Classify why an export failed, decide which failures are worth
+retrying (files locked on a share, a share that dropped out) and build
+a machine readable summary of a batch. The human readable details of
+each failure are still written to ITG_scrubber_errors_<date>.txt.
+See 'TPG ITG Export Scrubber Specification.rst' for more info.
+"""
+
+# imports
+import os
+import datetime
+import json
+
+
+# Failure classes, set on the PhaseTimer of a failed export
+FAILURE_NOT_FOUND = 'not_found'
+FAILURE_PERMISSION = 'permission'
+FAILURE_BAD_ZIP = 'bad_zip'
+FAILURE_OS = 'os_error'
+FAILURE_DEPENDENCY = 'missing_dependency'
+FAILURE_TIMEOUT = 'timeout'
+FAILURE_UNEXPECTED = 'unexpected'
+
+# Failures that can clear up on their own, such as a zip still locked
+# by the export job or a share that briefly went away
+TRANSIENT_FAILURES = frozenset({FAILURE_PERMISSION, FAILURE_OS})
+
+# Times a transient failure is retried, and the wait before the first
+# retry in seconds. The wait doubles on every retry.
+DEFAULT_RETRIES = 2
+DEFAULT_RETRY_DELAY = 5.0
+
+
+class ExportTimeout(Exception):
+    """Raised when an export runs past its time limit"""
+
+
+def retry_delay(retry_round, delay=DEFAULT_RETRY_DELAY) -> float:
+    """Seconds to wait before a round of retries, backing off
+    exponentially
+
+    :param retry_round: 0 for the first round of retries
+    :param delay: wait before the first round
+    :return: seconds to wait
+    """
+
+    return delay * 2 ** retry_round
+
+
+def summary_path(working_dir) -> str:
+    """Return the path of a new batch summary in working_dir
+
+    :param working_dir: directory the summary is written to
+    :return: full path to the json file
+    """
+
+    stamp = datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S')
+    return os.path.join(working_dir, f'ITG_scrubber_summary_{stamp}.json')
+
+
+class BatchSummary:
+    """Outcome of every export in a batch: status, failure class,
+    attempts made and output written"""
+
+    def __init__(self):
+        self.started = datetime.datetime.now()
+        self.exports = []
+
+    def record(self, input_zip, status, output=None, failure=None,
+               attempts=0) -> None:
+        """Add the final outcome of one export
+
+        :param input_zip: path of the export zip
+        :param status: 'ok', 'error' or 'skipped'
+        :param output: output file written, or None
+        :param failure: failure class of an error, or None
+        :param attempts: times the export was scrubbed in this batch
+        """
+
+        self.exports.append({
+            'input_zip': os.path.abspath(input_zip),
+            'status': status,
+            'failure': failure,
+            'attempts': attempts,
+            'output': output,
+        })
+
+    def counts(self) -> dict:
+        """Number of exports per status and per failure class"""
+
+        counts = {'ok': 0, 'error': 0, 'skipped': 0, 'failures': {}}
+        for export in self.exports:
+            counts[export['status']] += 1
+            if export['failure']:
+                failures = counts['failures']
+                failures[export['failure']] = \
+                    failures.get(export['failure'], 0) + 1
+        return counts
+
+    def as_dict(self) -> dict:
+        """JSON serializable summary of the batch"""
+
+        finished = datetime.datetime.now()
+        return {
+            'started': self.started.isoformat(timespec='seconds'),
+            'finished': finished.isoformat(timespec='seconds'),
+            'seconds': round((finished - self.started).total_seconds(), 2),
+            'counts': self.counts(),
+            'exports': self.exports,
+        }
+
+    def save(self, path) -> None:
+        """Write the summary as JSON, replacing path in one step"""
+
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.as_dict(), f, indent=2)
+        os.replace(temp_path, path)
@@ -13,22 +13,14 @@ See 'TPG ITG Export Scrubber Specification.rst' for more info.
 
 # imports
 import os
-from os.path import basename
-import shutil
-import csv
-import unicodedata
-from bs4 import BeautifulSoup
-from zipfile36 import ZipFile
-from openpyxl import Workbook, load_workbook
 import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog
 import sys
-import logging
-import datetime
-import pandas as pd
-import xlsxwriter
-import traceback
+import multiprocessing
+import ITG_export_scrub_engine as engine
+from ITG_export_scrub_jobs import ScrubJob, EVENT_MESSAGE, EVENT_STEP, \
+    EVENT_FINISHED
 
 
 class LabelInput(tk.Frame):
@@ -115,12 +107,18 @@ class MainPage(AppPage):
         self._vars = {'Batch Size': tk.StringVar(None, 'Folder'),
                       'Post Job': tk.StringVar(None, 'Delete'),
                       'Zip?': tk.StringVar(None, 'No'),
+                      'Workers': tk.IntVar(None, engine.default_workers()),
+                      'Skip Unchanged': tk.StringVar(None, 'Yes'),
                       }
 
         self.input_folder = ''
         self.input_file = ''
-        self.err_present = 0
         self.err_count = 0
+        self.job = None
+        self.quit_pending = False
+        # Label and progress bar of every export being scrubbed
+        self.file_bars = {}
+        self.bar_row = 0
 
         # Initialize Main Page GUI
         size_default = self._add_frame(
@@ -130,6 +128,12 @@ class MainPage(AppPage):
             'Delete or Keep original export when finished?'
         )
         zip_default = self._add_frame('Zip the output when finished?')
+        workers_default = self._add_frame(
+            'Worker processes to use?'
+        )
+        skip_default = self._add_frame(
+            'Skip exports already scrubbed (folder only)?'
+        )
         buttons = self._add_frame('')
 
         LabelInput(size_default, '', input_class=ttk.Radiobutton,
@@ -150,6 +154,19 @@ class MainPage(AppPage):
                    ).grid(row=2, column=0, sticky=(tk.W + tk.E)
                           )
 
+        LabelInput(workers_default, '', input_class=ttk.Spinbox,
+                   var=self._vars['Workers'],
+                   input_args={'from_': 1,
+                               'to': engine.default_workers() * 2}
+                   ).grid(row=3, column=0, sticky=(tk.W + tk.E)
+                          )
+
+        LabelInput(skip_default, '', input_class=ttk.Radiobutton,
+                   var=self._vars['Skip Unchanged'],
+                   input_args={'values': ['Yes', 'No']}
+                   ).grid(row=4, column=0, sticky=(tk.W + tk.E)
+                          )
+
         self.run_button = tk.Button(buttons, text='Run',
                                     command=self._on_run
                                     )
@@ -167,341 +184,33 @@ class MainPage(AppPage):
         )
         self.quit_button.grid(row=3, column=0, sticky='ew')
 
+        self.cancel_button = tk.Button(buttons, text='Cancel',
+                                       command=self._on_cancel,
+                                       state=tk.DISABLED
+                                       )
+        self.cancel_button.grid(row=3, column=1, sticky='ew')
+
         self.status = tk.StringVar(
             None, 'Status: '
                   'Please select a target to continue...'
         )
         ttk.Label(
             self, textvariable=self.status, wraplength=225, justify='left'
-        ).grid(sticky=(tk.W + tk.E), row=4, padx=10)
-
-    def process_exports(self, input_zip, post_task, zip_task) -> int:
-        """Main processing method. Take a TPG ITG export, unzip it,
-        ignore unneeded data, clean left over csv's of empty columns,
-        and make it readable
-
-        :param input_zip: any zip file. Non ITG exports will be unzipped,
-                        and ignored once contents are detected as invalid.
-        :param post_task: Option to either delete or keep input zip
-                        when processing is complete.
-        :param zip_task: Option to either zip the output or not
-                        when processing is complete.
-        :return: Integer 0 or 1. 0 means no error occurred.
-        1 means error log is present.
-        """
-
-        # List of CSV's to extract. Ignore all else
-        keep_csv = [
-            'applications-licensing.csv', 'backup.csv',
-            'backups-managed.csv',
-            'battery-backup-ups.csv', 'configurations.csv',
-            'domain-hosting.csv',
-            'email.csv', 'file-sharing.csv', 'internet-wan.csv',
-            'lan.csv', 'passwords.csv', 'printing.csv',
-            'vendors.csv', 'voice-pbx-fax.csv', 'wireless.csv',
-                    ]
-
-        # Column names that if left in first column after processing,
-        # should be sorted by in the final sheet
-        sorters = ['Name', 'name', 'Hostname', 'Printer Name',
-                   'Description', 'Vendor Name'
-                   ]
-
-        # Prep the processing paths
-        explode_path = input_zip.split('/')
-        new_explode_path = [i.replace('/', '\\') for i in explode_path]
-        input_zip = '\\'.join(new_explode_path)
-        new_explode_path.pop(-1)
-        working_dir = '\\'.join(new_explode_path) + '\\'
-        export_dir = working_dir + 'itg_unzipped\\'
-        error_log = working_dir + (f'ITG_scrubber_errors_'
-                                   f'{datetime.date.today()}.txt')
-
-        # Dictionary to contain all customer sheets:dataframe
-        sheets_dict = {}
-
-        # Unzip input
-        try:
-            with ZipFile(input_zip, 'r') as in_zip:
-                for file in in_zip.infolist():
-                    if file.filename in keep_csv:
-                        in_zip.extract(file, export_dir)
-        except FileNotFoundError:
-            self.log_error(error_log, f'{input_zip} not found. '
-                                      f'More Info: {traceback.format_exc()}'
-                                      f'\n\n'
-                           )
-            return 1
-        except PermissionError:
-            self.log_error(error_log, f'{input_zip} '
-                                      f'permission denied.'
-                                      f' Try Running again as admin. '
-                                      f'More Info: {traceback.format_exc()}'
-                                      f'\n\n'
-                           )
-            return 1
-        except in_zip.BadZipFile:
-            self.log_error(error_log, f'{input_zip}'
-                                      f' may be corrupt. '
-                                      f'More Info: {traceback.format_exc()}'
-                                      f'\n\n'
-                           )
-            return 1
-        except OSError:
-            self.log_error(error_log, f'{input_zip} '
-                                      f'caused an OS error. '
-                                      f' Drive may be full or '
-                                      f'path is no longer valid. '
-                                      f'More Info: {traceback.format_exc()}'
-                                      f'\n\n'
-                           )
-            return 1
-
-        # Check if the zip is a valid export(export_dir will not exist)
-        if os.path.exists(export_dir):
-            # Gather list of files
-            raw_input_files = [f for f in os.listdir(export_dir)]
-        else:
-            self.status.set(f'{input_zip} is not a valid ITG export')
-            Application.update(self)
-            return 0
-
-        # If Backup-managed is present, ignore backup
-        if 'backups-managed.csv' in raw_input_files:
-            input_files = [f for f in raw_input_files if f != 'backup.csv']
-        else:
-            input_files = [f for f in raw_input_files]
-
-        # From any of the csvs, pull customer name from column B
-        with open(export_dir + input_files[0], 'r',
-                  encoding='utf-8') as csv_file:
-            headers = csv_file.readline().strip('\n').split(',')
-            reader = csv.reader(csv_file)
-            customer_name = list(reader)[0][1]
-
-        # Iterate through every remaining csv,
-        # and make changes in memory
-        for file in input_files:
-            self.status.set(f'Processing {customer_name} ...')
-            Application.update(self)
-            # Reset columns to delete list
-            # (columns that always are deleted/ignored)
-            delete_columns = ['id', 'organization', 'Category',
-                              'Business Impact',
-                              'Client Subject Matter Expert',
-                              'Importance', 'archived',
-                              'Backup Estimated Start Date',
-                              'FlexAssset Review Date',
-                              'FlexAsset Review Date',
-                              'Backup Radar Reporting Schedule',
-                              'hostname', 'manufacturer',
-                              'position', 'contact', 'location',
-                              'configuration_interfaces',
-                              'DHCP Exclusions', 'one_time_password',
-                              'Printer Management Login',
-                              'installed_by',
-                              'Equipment make & Model',
-                              'resource_type', 'resource_id',
-                              'configuration_status', 'asset_tag',
-                              'DHCP Server', 'DHCP Scope',
-                              'DHCP Reservations', 'DNS Server(s)',
-                              'Default Gateway Device', 'Firewall',
-                              'Access Point(s)',
-                              'Wireless Controller (Application)',
-                              'Wireless Controller (Hardware)',
-                              'Management Credentials', 'VLAN #',
-                              'Backup Radar Report Recipients (Email)'
-                              ' or Link Contacts',
-                              'Backup Radar Reporting Notes',
-                              'Backup Server/NAS Management Login',
-                              'Local Backup Encryption Key',
-                              'Backup Copy Job Name',
-                              'Backup Copy Target',
-                              'Backup Copy Encryption',
-                              'Configuration Backup to Cloud Connect?',
-                              'SMB Login',
-                              ]
-
-            # Continue with unpacking current csv to list of lists
-            working_rows = []
-            with open(export_dir + file, 'r', encoding='utf-8') as csv_file:
-                headers = csv_file.readline().strip('\n').split(',')
-                reader = csv.reader(csv_file)
-                for row in reader:
-                    new_row = []
-                    for cell in row:
-                        # Detect html in cell and convert if so.
-                        if bool(
-                                BeautifulSoup(cell, 'lxml'
-                                              ).find()
-                                ):
-                            cell = BeautifulSoup(cell, 'lxml').text
-
-                        # normalize text
-                        cell = unicodedata.normalize(
-                            'NFKD', cell
-                        )
-                        new_row.append(cell)
-                    working_rows.append(new_row)
-
-            # Find the archive column and keep track of it
-            # (it's usually last but not always)
-            # Also find config status column
-            archive_index = -1
-            configuration_status_index = 0
-            for index, value in enumerate(headers):
-                if value == 'archived':
-                    archive_index = index
-                if file == 'configurations.csv':
-                    if value == 'configuration_status':
-                        configuration_status_index = index
-
-            # go through every row and delete any row with archive set to 'Yes'
-            # and any configuration status in configurations csv
-            # other than Active
-            top_index_current = len(working_rows) - 1
-            for index, value in enumerate(reversed(working_rows)):
-                if value[archive_index] == 'Yes':
-                    del working_rows[top_index_current - index]
-                if configuration_status_index != 0:
-                    if value[configuration_status_index] != 'Active':
-                        del working_rows[top_index_current - index]
-
-            # Find empty columns
-            for i in range(len(headers)):
-                i_empty = 0
-                for value in working_rows:
-                    if value[i] == '':
-                        i_empty += 1
-                if i_empty == len(working_rows):
-                    delete_columns.append(headers[i])
-
-            # Ignore all blank columns and columns to be "deleted"
-            clean_rows = []
-            for row in working_rows:
-                new_row = []
-                for i in range(len(row)):
-                    if headers[i] not in delete_columns:
-                        new_row.append(row[i])
-                clean_rows.append(new_row)
-
-            # Clean up headers to match
-            new_headers = [h for h in headers if h not in delete_columns]
-
-            # Convert the list of lists to a pandas DataFrame
-            columns_dict = {}
-            for row in clean_rows:
-                for i, value in enumerate(row):
-                    columns_dict.setdefault(new_headers[i], []).append(value)
-            df = pd.DataFrame(columns_dict)
-
-            # Sort any sheets if name column is present and
-            # Populate the Pandas dataframe into a dictionary to
-            # populate the workbook after all data is processed
-            if len(new_headers) > 0:
-                if new_headers[0] in sorters:
-                    sheets_dict.update({file.split('.')[0]: df.sort_values(
-                        by=new_headers[0])}
-                    )
-                else:
-                    sheets_dict.update({file.split('.')[0]: df})
-            else:
-                continue
-
-        # Populate Workbook with all sheets/tables and data
-        wb_file = working_dir + f'{customer_name}_export.xlsx'
-        if os.path.exists(wb_file):
-            try:
-                os.remove(wb_file)
-            except PermissionError:
-                self.log_error(error_log, f'Attempted '
-                                          f'deleting old {wb_file}, '
-                                          f' but permission denied.'
-                                          f' Try running again as admin. '
-                                          f'More Info: {traceback.format_exc()}'
-                                          f'\n\n'
-                               )
-                shutil.rmtree(export_dir)
-                return 1
-        wb = xlsxwriter.Workbook(wb_file)
-        for key, value in sheets_dict.items():
-            sheet = wb.add_worksheet(key)
-            sheet.add_table(0, 0, value.shape[0], value.shape[1] - 1, {
-                'data': value.values.tolist(),
-                'columns': [{'header': col} for col in value.columns]
-            })
-        wb.close()
-
-        # Delete the unzipped original export
-        shutil.rmtree(export_dir)
-
-        # Open workbook again with openpyxl and make final adjustments
-        # Find and set uniform column width
-        wb = load_workbook(wb_file)
-        for sheet in wb.worksheets:
-            for col in sheet.columns:
-                max_length = 0
-                column = col[0].column_letter
-                for cell in col:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                if max_length > 50:
-                    max_length = 50
-                adjusted_width = (max_length + 2) * 1.2
-                sheet.column_dimensions[column].width = adjusted_width
-
-        wb.save(wb_file)
-
-        # Delete or keep unzipped export
-        if post_task == 'Delete':
-            try:
-                os.remove(input_zip)
-            except PermissionError:
-                self.log_error(error_log, f'Attempted '
-                                          f'deleting {input_zip}, '
-                                          f' but permission denied.'
-                                          f' Try running again as admin. '
-                                          f'More Info: {traceback.format_exc()}'
-                                          f'\n\n'
-                               )
-                return 1
-
-        self.status.set(f'Processing of {customer_name} complete.')
-        Application.update(self)
-
-        # To zip or not to zip output file (needs to be zipped for email)
-        if zip_task == 'Yes':
-            out_zip = f'{working_dir}\\{customer_name}_export.zip'
-            if os.path.exists(out_zip):
-                try:
-                    os.remove(out_zip)
-                except PermissionError:
-                    self.log_error(error_log, f'Attempted '
-                                              f'deleting {input_zip}, '
-                                              f' but permission denied.'
-                                              f' Try running again as admin. '
-                                              f'More Info: '
-                                              f'{traceback.format_exc()}'
-                                              f'\n\n'
-                                   )
-                    return 1
-            with ZipFile(out_zip, 'w') as f:
-                f.write(wb_file, basename(wb_file))
-            try:
-                os.remove(wb_file)
-            except PermissionError:
-                self.log_error(error_log, f'Attempted '
-                                          f'deleting {wb_file} '
-                                          f'as it has been zipped, '
-                                          f' but permission denied.'
-                                          f' Try running again as admin. '
-                                          f'More Info: {traceback.format_exc()}'
-                                          f'\n\n'
-                               )
-        return 0
+        ).grid(sticky=(tk.W + tk.E), row=6, padx=10)
+
+        # Overall progress, throughput and a bar per running export
+        progress_frame = ttk.LabelFrame(self, text='Progress')
+        progress_frame.grid(sticky=(tk.W + tk.E), row=7)
+        progress_frame.columnconfigure(0, weight=1)
+        self.total_bar = ttk.Progressbar(progress_frame, maximum=100)
+        self.total_bar.grid(row=0, column=0, sticky=(tk.W + tk.E))
+        self.throughput = tk.StringVar(None, '')
+        ttk.Label(
+            progress_frame, textvariable=self.throughput
+        ).grid(row=1, column=0, sticky=(tk.W + tk.E))
+        self.bars_frame = ttk.Frame(progress_frame)
+        self.bars_frame.grid(row=2, column=0, sticky=(tk.W + tk.E))
+        self.bars_frame.columnconfigure(1, weight=1)
 
     def _on_run(self):
         """Command to run scrubber on target(s)"""
@@ -515,42 +224,148 @@ class MainPage(AppPage):
                 self.status.set('No target chosen. \n'
                                 'Please choose a target zip file...')
         else:
-            # Process zip file(s)
+            # Process the target zip, or all zips in the target
+            # directory, in the background. Only folder runs skip
+            # exports that are already up to date.
             if self.input_folder == '':
-                self.status.set(
-                    f'Processing {self.input_file} ...')
-                Application.update(self)
-                # Process target zip
-                self.err_present = self.process_exports(self.input_file,
-                                     self._vars['Post Job'].get(),
-                                     self._vars['Zip?'].get(),
-                                     )
-                self.input_file = ''
-            else:
-                for file in os.listdir(self.input_folder):
-                    self.status.set(f'Processing {file} ...')
-                    Application.update(self)
-                    # Process all zips in target directory
-                    if '.zip' in file:
-                        self.err_present = self.process_exports(
-                            self.input_folder + '/' + file,
-                            self._vars['Post Job'].get(),
-                            self._vars['Zip?'].get(),
-                        )
-                        if self.err_present == 1:
-                            self.err_count += 1
-                self.input_folder = ''
-
-            # Check and alert on errors present during run
-            if self.err_count == 0 and self.err_present == 0:
-                self.status.set('Processing Complete. '
-                                'Add more targets to continue.')
+                zips = [self.input_file]
+                skip_unchanged = False
             else:
-                self.status.set('Processing Complete, '
-                                'but errors are present.'
-                                '\nPlease refer to the error file which will '
-                                'be contained in the target directory.')
-                self.err_count = 0
+                zips = engine.find_exports([self.input_folder])
+                skip_unchanged = self._vars['Skip Unchanged'].get() == 'Yes'
+            self.input_file = ''
+            self.input_folder = ''
+            self._start_job(zips, skip_unchanged)
+
+    def _start_job(self, zips, skip_unchanged):
+        """Start a background job for zips and poll it for progress
+        so the window stays responsive
+
+        :param zips: list of zip file paths to process
+        :param skip_unchanged: skip exports already scrubbed
+        """
+
+        try:
+            workers = max(1, self._vars['Workers'].get())
+        except tk.TclError:
+            workers = engine.default_workers()
+
+        self.job = ScrubJob(zips, self._vars['Post Job'].get(),
+                            self._vars['Zip?'].get(), workers,
+                            skip_unchanged=skip_unchanged)
+        self.run_button.configure(state=tk.DISABLED)
+        self.select_target.configure(state=tk.DISABLED)
+        self.cancel_button.configure(state=tk.NORMAL)
+        self.total_bar['value'] = 0
+        self.throughput.set('')
+        self.status.set(f'Processing {len(zips)} export(s) '
+                        f'with {workers} worker(s) ...')
+        self.job.start()
+        self.after(100, self._poll_job)
+
+    def _poll_job(self):
+        """Show progress of the background job and reschedule
+        until it is done"""
+
+        job = self.job
+        for kind, input_zip, payload in job.poll():
+            if kind == EVENT_MESSAGE:
+                self.status.set(payload)
+            elif kind == EVENT_STEP:
+                _, done, total, _ = payload
+                self._file_bar(input_zip)['value'] = done * 100 / total
+            elif kind == EVENT_FINISHED:
+                self._remove_file_bar(input_zip)
+                if payload[0] == engine.RESULT_SKIPPED:
+                    self.status.set(f'Skipped {os.path.basename(input_zip)}'
+                                    f', output is up to date')
+                else:
+                    self.status.set(
+                        f'Finished {os.path.basename(input_zip)} '
+                        f'({len(job.results)} of {len(job.zips)})'
+                    )
+
+        # Exports that only sent messages so far still get a bar
+        for input_zip in job.running():
+            self._file_bar(input_zip)
+        self.total_bar['value'] = job.fraction() * 100
+        eta = job.eta_seconds()
+        if eta is None:
+            eta_text = '--:--'
+        else:
+            eta_text = f'{int(eta) // 60}:{int(eta) % 60:02}'
+        self.throughput.set(f'{job.rows_per_second():,.0f} rows/s, '
+                            f'{job.files_per_minute():.1f} files/min, '
+                            f'ETA {eta_text}')
+
+        if not job.finished:
+            self.after(100, self._poll_job)
+            return
+
+        for input_zip in list(self.file_bars):
+            self._remove_file_bar(input_zip)
+        self.err_count = sum(1 for result in job.results.values()
+                             if result == engine.RESULT_ERROR)
+        self.job = None
+        if self.quit_pending:
+            sys.exit()
+        self.run_button.configure(state=tk.NORMAL)
+        self.select_target.configure(state=tk.NORMAL)
+        self.cancel_button.configure(state=tk.DISABLED)
+        self._show_run_result(job)
+
+    def _file_bar(self, input_zip):
+        """Return the progress bar of input_zip, adding it if needed"""
+
+        if input_zip not in self.file_bars:
+            # Rows of removed bars are not reused, grid leaves
+            # empty rows with no height
+            self.bar_row += 1
+            row = self.bar_row
+            label = ttk.Label(self.bars_frame,
+                              text=os.path.basename(input_zip)[:30])
+            label.grid(row=row, column=0, sticky=tk.W)
+            bar = ttk.Progressbar(self.bars_frame, maximum=100)
+            bar.grid(row=row, column=1, sticky=(tk.W + tk.E))
+            self.file_bars[input_zip] = (label, bar)
+        return self.file_bars[input_zip][1]
+
+    def _remove_file_bar(self, input_zip):
+        """Remove the progress bar of a finished export"""
+
+        for widget in self.file_bars.pop(input_zip, ()):
+            widget.destroy()
+
+    def _show_run_result(self, job):
+        """Update status label with the result of the last run
+
+        :param job: the finished ScrubJob
+        """
+
+        # Check and alert on errors present during run
+        if job.cancelled:
+            scrubbed = sum(1 for result in job.results.values()
+                           if result != engine.RESULT_SKIPPED)
+            message = (f'Processing Cancelled after {scrubbed} '
+                       f'export(s). Run again to continue.')
+        else:
+            message = 'Processing Complete. Add more targets to continue.'
+        if self.err_count != 0:
+            message += ('\nErrors are present. '
+                        'Please refer to the error file which will '
+                        'be contained in the target directory.')
+            self.err_count = 0
+        self.status.set(message)
+
+    def _on_cancel(self):
+        """Command to cancel the running job. Exports already being
+        scrubbed are finished first."""
+
+        if self.job is not None:
+            self.job.cancel()
+            self.cancel_button.configure(state=tk.DISABLED)
+            self.status.set('Cancelling. Waiting for exports already '
+                            'running to finish ...')
 
     def _on_target(self):
         """Command to choose a target folder/file"""
@@ -588,23 +403,16 @@ class MainPage(AppPage):
                             f'\nChoose Run to continue...'
                             )
 
-    @staticmethod
-    def log_error(err_file, message) -> None:
-        """Simple method for opening passed txt file
-        and appending message
-
-        :param err_file: txt file
-        :param message: string to append.
-        This method will prepend current date and time
-        """
-
-        with open(err_file, 'a') as f:
-            f.write(f'Error_{datetime.datetime.now()}_{message}\n')
+    def _on_quit(self):
+        """Command to exit program. A running job is cancelled and
+        the program exits once its running exports are finished."""
 
-    @staticmethod
-    def _on_quit():
-        """Command to exit program"""
-        sys.exit()
+        if self.job is None:
+            sys.exit()
+        self.quit_pending = True
+        self._on_cancel()
+        self.status.set('Quitting once exports already running '
+                        'are finished ...')
 
 
 class Application(tk.Tk):
@@ -628,6 +436,8 @@ class Application(tk.Tk):
 
 
 if __name__ == "__main__":
+    # Needed for worker processes when frozen into an executable
+    multiprocessing.freeze_support()
     app = Application()
     app.grid_columnconfigure(0, weight=1)
     app.mainloop()
\ No newline at end of file
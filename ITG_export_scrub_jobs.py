@@ -0,0 +1,261 @@
+"""
+ITG_export_scrub_jobs.py
+
+Author: Josh Smith
+
+Purpose: Run exports in the background for the GUI. A ScrubJob drives
+a process pool from its own thread and sends progress back through a
+queue that the GUI polls with after(), so the window never waits on a
+scrub. Tracks progress per export, throughput and time left, and can
+be cancelled between exports.
+See 'TPG ITG Export Scrubber Specification.rst' for more info.
+"""
+
+# imports
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import ITG_export_scrub_engine as engine
+
+
+# Kinds of events put on ScrubJob.events. Each event is a tuple of
+# (kind, input_zip, payload).
+EVENT_MESSAGE = 'message'    # payload: status message string
+EVENT_STEP = 'step'          # payload: (name, done, total, rows)
+EVENT_FINISHED = 'finished'  # payload: (result, output file or None)
+EVENT_DONE = 'done'          # payload: True if the job was cancelled
+
+# Event queue of the job that started this worker process
+_worker_events = None
+
+
+def _init_worker(events) -> None:
+    """Process pool initializer. Keep the job's event queue, a queue
+    can only be handed to a worker process when it starts."""
+
+    global _worker_events
+    _worker_events = events
+
+
+class QueueProgress:
+    """Engine progress callback that puts the messages and steps of
+    one export on the event queue of the worker process. Only holds
+    the zip path, so it pickles with the export sent to the worker."""
+
+    def __init__(self, input_zip):
+        self.input_zip = input_zip
+
+    def __call__(self, message) -> None:
+        _worker_events.put((EVENT_MESSAGE, self.input_zip, message))
+
+    def step(self, name, done, total, rows) -> None:
+        _worker_events.put((EVENT_STEP, self.input_zip,
+                            (name, done, total, rows)))
+
+
+class ScrubJob:
+    """A batch of exports scrubbed in worker processes, started from
+    a background thread. Call poll() from the GUI thread to take
+    events off the queue and update the progress counters."""
+
+    def __init__(self, zips, post_task='Keep', zip_task='No', workers=1,
+                 low_memory=False, rules=None, skip_unchanged=False):
+        """
+        :param zips: list of zip file paths to process
+        :param post_task: 'Delete' or 'Keep' the input zip when finished
+        :param zip_task: 'Yes' or 'No' to zip the output when finished
+        :param workers: number of worker processes. When only one
+                        export needs scrubbing, its csv's are read by
+                        this many processes instead.
+        :param low_memory: use the low memory streaming writer
+        :param rules: compiled ScrubRules, defaults to the rules file
+                        shipped with the scrubber.
+        :param skip_unchanged: skip exports the manifest shows are
+                        already up to date
+        """
+
+        self.zips = list(zips)
+        self.post_task = post_task
+        self.zip_task = zip_task
+        self.workers = max(1, workers)
+        self.low_memory = low_memory
+        self.rules = rules
+        self.skip_unchanged = skip_unchanged
+
+        self.events = multiprocessing.Queue()
+        # Progress of every export, updated by poll()
+        self.exports = {input_zip: {'started': False, 'done': 0,
+                                    'total': 0, 'rows': 0,
+                                    'result': None}
+                        for input_zip in self.zips}
+        self.results = {}
+        self.rows = 0
+        self.finished = False
+        self.start_time = None
+        self.end_time = None
+        self._cancel = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """Start scrubbing in a background thread"""
+
+        self.start_time = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def cancel(self) -> None:
+        """Stop starting new exports. Exports already running are
+        finished, so no half written workbook is left behind."""
+
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def _run(self) -> None:
+        """Background thread. Skip unchanged exports, then keep every
+        worker busy with one export until all are done or the job is
+        cancelled."""
+
+        manifests = None
+        try:
+            rules = self.rules or engine.load_rules()
+            options = engine.ScrubOptions(post_task=self.post_task,
+                                          zip_task=self.zip_task,
+                                          low_memory=self.low_memory)
+            manifests = engine.batch_manifests(rules, options)
+            todo = []
+            for input_zip in self.zips:
+                if self.skip_unchanged and manifests.is_current(input_zip):
+                    self.events.put((EVENT_FINISHED, input_zip,
+                                     (engine.RESULT_SKIPPED, None)))
+                else:
+                    todo.append(input_zip)
+            if not todo:
+                return
+
+            workers = min(self.workers, len(todo))
+            options = options.replace(
+                sheet_workers=self.workers if len(todo) == 1 else 1)
+            pending = iter(todo)
+            running = {}
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=_init_worker,
+                                     initargs=(self.events,)) as executor:
+                while True:
+                    # Only start the next export while not cancelled
+                    while len(running) < workers and not self.cancelled:
+                        input_zip = next(pending, None)
+                        if input_zip is None:
+                            break
+                        future = executor.submit(
+                            engine.scrub_export, input_zip, options,
+                            QueueProgress(input_zip), rules
+                        )
+                        running[future] = input_zip
+                    if not running:
+                        break
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        input_zip = running.pop(future)
+                        result, output, _, _ = engine.collect_result(
+                            input_zip, future)
+                        manifests.record(input_zip, output)
+                        self.events.put((EVENT_FINISHED, input_zip,
+                                         (result, output)))
+        finally:
+            if manifests is not None:
+                manifests.save()
+            self.events.put((EVENT_DONE, None, self.cancelled))
+
+    def poll(self) -> list:
+        """Take every waiting event off the queue and update the
+        progress counters. Call from the GUI thread.
+
+        :return: list of (kind, input_zip, payload) event tuples
+        """
+
+        events = []
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            kind, input_zip, payload = event
+            if kind == EVENT_DONE:
+                self.finished = True
+                self.end_time = time.perf_counter()
+            elif kind == EVENT_FINISHED:
+                self.exports[input_zip]['result'] = payload[0]
+                self.results[input_zip] = payload[0]
+            else:
+                export = self.exports[input_zip]
+                if export['result'] is not None:
+                    # Worker events can arrive after the result
+                    continue
+                export['started'] = True
+                if kind == EVENT_STEP:
+                    name, export['done'], export['total'], rows = payload
+                    export['rows'] += rows
+                    self.rows += rows
+            events.append(event)
+        return events
+
+    def running(self) -> list:
+        """Exports that have started and not finished yet"""
+
+        return [input_zip for input_zip, export in self.exports.items()
+                if export['started'] and export['result'] is None]
+
+    def elapsed(self) -> float:
+        """Seconds since the job started, or that it ran for"""
+
+        if self.start_time is None:
+            return 0.0
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    def fraction(self) -> float:
+        """Share of the exports to scrub that is done, counting
+        the csv's finished of exports still running. Skipped exports
+        are left out."""
+
+        skipped = sum(1 for result in self.results.values()
+                      if result == engine.RESULT_SKIPPED)
+        total = len(self.zips) - skipped
+        if total == 0:
+            return 1.0
+        done = len(self.results) - skipped
+        for input_zip in self.running():
+            export = self.exports[input_zip]
+            if export['total']:
+                done += export['done'] / export['total']
+        return min(done / total, 1.0)
+
+    def rows_per_second(self) -> float:
+        """Rows written to sheets per second so far"""
+
+        elapsed = self.elapsed()
+        return self.rows / elapsed if elapsed else 0.0
+
+    def files_per_minute(self) -> float:
+        """Exports scrubbed (not skipped) per minute so far"""
+
+        elapsed = self.elapsed()
+        scrubbed = sum(1 for result in self.results.values()
+                       if result != engine.RESULT_SKIPPED)
+        return scrubbed * 60 / elapsed if elapsed else 0.0
+
+    def eta_seconds(self):
+        """Estimated seconds left from the progress so far
+
+        :return: float, or None until some progress is made
+        """
+
+        fraction = self.fraction()
+        if fraction <= 0:
+            return None
+        return self.elapsed() * (1 - fraction) / fraction
@@ -0,0 +1,167 @@
+"""
+ITG_export_scrub_manifest.py
+
+Author: Josh Smith
+
+Purpose: Keep a manifest of scrubbed exports in each target directory,
+so a repeated run can skip exports whose output is already up to date.
+Each entry records the input zip's size, modification time and sha256,
+the rules and options used, and the output file written.
+See 'TPG ITG Export Scrubber Specification.rst' for more info.
+"""
+
+# imports
+import os
+import json
+import hashlib
+
+
+MANIFEST_NAME = 'ITG_scrubber_manifest.json'
+MANIFEST_VERSION = 1
+
+
+def file_sha256(path) -> str:
+    """Return the sha256 hex digest of a file, read in chunks"""
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ExportManifest:
+    """Manifest of the exports scrubbed in one directory.
+    Entries are keyed by zip file name, so lookups are O(1) and the
+    input is only hashed when its size or modification time changed."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.exports = {}
+        self.changed = False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                self.exports = data.get('exports', {})
+        except (OSError, ValueError):
+            # Missing or unreadable manifest, scrub everything again
+            self.exports = {}
+
+    def is_current(self, input_zip, rules_key, options) -> bool:
+        """Check if an export was already scrubbed from the same input
+        with the same rules and options, and its output still exists
+
+        :param input_zip: path of the export zip
+        :param rules_key: rules version and fingerprint
+        :param options: dictionary of options that change the output
+        :return: True if the export can be skipped
+        """
+
+        entry = self.exports.get(os.path.basename(input_zip))
+        if entry is None:
+            return False
+        if entry['rules'] != rules_key or entry['options'] != options:
+            return False
+        if not os.path.exists(entry['output']):
+            return False
+
+        stat = os.stat(input_zip)
+        if (entry['size'] == stat.st_size
+                and entry['mtime_ns'] == stat.st_mtime_ns):
+            return True
+
+        # Touched or copied, only skip if the content is the same
+        if entry['size'] != stat.st_size:
+            return False
+        if file_sha256(input_zip) != entry['sha256']:
+            return False
+        entry['mtime_ns'] = stat.st_mtime_ns
+        self.changed = True
+        return True
+
+    def record(self, input_zip, rules_key, options, output,
+               sha256=None) -> None:
+        """Add or replace the entry of a scrubbed export
+
+        :param input_zip: path of the export zip
+        :param rules_key: rules version and fingerprint
+        :param options: dictionary of options that change the output
+        :param output: path of the workbook or zip written
+        :param sha256: digest of input_zip if already known
+        """
+
+        stat = os.stat(input_zip)
+        self.exports[os.path.basename(input_zip)] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': sha256 or file_sha256(input_zip),
+            'rules': rules_key,
+            'options': options,
+            'output': output,
+        }
+        self.changed = True
+
+    def save(self) -> None:
+        """Write the manifest if anything changed"""
+
+        if not self.changed:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': MANIFEST_VERSION,
+                       'exports': self.exports}, f, indent=2)
+        os.replace(temp_path, self.path)
+        self.changed = False
+
+
+class ManifestSet:
+    """Manifests of every target directory in a batch, for one set of
+    rules and options"""
+
+    def __init__(self, rules_key, options):
+        self.rules_key = rules_key
+        self.options = options
+        self.manifests = {}
+
+    def manifest_for(self, input_zip) -> ExportManifest:
+        """Return the manifest of the directory holding input_zip"""
+
+        directory = os.path.dirname(os.path.abspath(input_zip))
+        if directory not in self.manifests:
+            self.manifests[directory] = ExportManifest(directory)
+        return self.manifests[directory]
+
+    def is_current(self, input_zip) -> bool:
+        """Check if input_zip can be skipped. See
+        ExportManifest.is_current()"""
+
+        if not os.path.exists(input_zip):
+            return False
+        return self.manifest_for(input_zip).is_current(
+            input_zip, self.rules_key, self.options
+        )
+
+    def output(self, input_zip):
+        """Return the output recorded for input_zip, or None"""
+
+        entry = self.manifest_for(input_zip).exports.get(
+            os.path.basename(input_zip)
+        )
+        return entry['output'] if entry else None
+
+    def record(self, input_zip, output) -> None:
+        """Record a successful scrub. Inputs deleted by the post job
+        are not recorded, there is nothing left to skip."""
+
+        if output is None or not os.path.exists(input_zip):
+            return
+        self.manifest_for(input_zip).record(input_zip, self.rules_key,
+                                            self.options, output)
+
+    def save(self) -> None:
+        """Write every manifest that changed"""
+
+        for manifest in self.manifests.values():
+            manifest.save()
@@ -0,0 +1,103 @@
+"""
+ITG_export_scrub_options.py
+
+Author: Josh Smith
+
+Purpose: Options of one scrub, passed from the command line, the watcher
+and the persistent worker down to the engine as one object instead of a
+long list of arguments. Options are plain values, so they pickle with
+the export sent to a worker process.
+See 'TPG ITG Export Scrubber Specification.rst' for more info.
+"""
+
+# imports
+import copy
+from ITG_export_scrub_archive import DEFAULT_COMPRESSION
+
+
+class ScrubOptions:
+    """What to write for an export and how to run it. Create with
+    keyword arguments, anything not given keeps its default."""
+
+    def __init__(self, post_task='Keep', zip_task='No', low_memory=False,
+                 output_format='xlsx', compression=DEFAULT_COMPRESSION,
+                 report=False, profile=False, sheet_workers=1,
+                 html_cache=None, delta=False, memory_budget=None,
+                 time_limit=None):
+        """
+        :param post_task: 'Delete' or 'Keep' the input zip when finished
+        :param zip_task: 'Yes' or 'No' to zip the output when finished
+        :param low_memory: stream each csv twice (once to plan, once to
+                        write) instead of holding every sheet in memory
+        :param output_format: 'xlsx' workbook (default), 'csv' zip of
+                        csv's or 'parquet' directory of parquet files
+        :param compression: compression of output zips as method[:level],
+                        see ITG_export_scrub_archive.parse_compression()
+        :param report: append a JSON line with phase times and per sheet
+                        statistics to ITG_scrubber_report_<date>.jsonl
+        :param profile: run under cProfile and dump the stats to
+                        <zip name>_profile.prof
+        :param sheet_workers: processes reading the csv's of an export.
+                        1 reads them in the scrubbing process.
+        :param html_cache: optional path of the persistent html cache
+                        shared by every run and worker process
+        :param delta: also write the rows added, removed and modified
+                        since the last scrub of the client to
+                        <customer>_export_delta.xlsx
+        :param memory_budget: bytes an export may hold in memory. An
+                        export estimated to need more is processed in
+                        low memory mode instead.
+        :param time_limit: seconds an export may take before it is
+                        stopped and logged as an error
+        """
+
+        self.post_task = post_task
+        self.zip_task = zip_task
+        self.low_memory = low_memory
+        self.output_format = output_format
+        self.compression = compression
+        self.report = report
+        self.profile = profile
+        self.sheet_workers = sheet_workers
+        self.html_cache = html_cache
+        self.delta = delta
+        self.memory_budget = memory_budget
+        self.time_limit = time_limit
+
+    def replace(self, **changes):
+        """Return a copy with some options changed
+
+        :param changes: option name:value pairs
+        :return: new ScrubOptions
+        """
+
+        unknown = [name for name in changes if not hasattr(self, name)]
+        if unknown:
+            raise TypeError(f'Unknown scrub options: {", ".join(unknown)}')
+        options = copy.copy(self)
+        options.__dict__.update(changes)
+        return options
+
+    def manifest_options(self) -> dict:
+        """Options that change the output, recorded in the manifest so
+        an export scrubbed with other options is scrubbed again"""
+
+        options = {'zip_task': self.zip_task,
+                   'low_memory': self.low_memory,
+                   'output_format': self.output_format,
+                   'compression': self.compression}
+        # The budget decides which exports fall back to low memory
+        # mode, from the zip alone. A run with another budget (or none)
+        # scrubs them again, so no fallback output is kept by mistake.
+        if self.memory_budget and not self.low_memory:
+            options['memory_budget'] = self.memory_budget
+        # Exports scrubbed before deltas were turned on have no
+        # snapshot yet, so they are scrubbed once more to take one
+        if self.delta:
+            options['delta'] = True
+        return options
+
+    def __repr__(self):
+        settings = ', '.join(f'{name}={value!r}'
+                             for name, value in vars(self).items())
+        return f'ScrubOptions({settings})'
@@ -0,0 +1,134 @@
+"""
+ITG_export_scrub_rules.py
+
+Author: Josh Smith
+
+Purpose: Load the scrub rules (csv's to keep, sorter columns and
+columns to delete) from a versioned JSON rules file and compile them
+once into frozensets and per-file column plans that are reused for
+every export in a batch.
+See 'TPG ITG Export Scrubber Specification.rst' for more info.
+"""
+
+# imports
+import os
+import json
+import hashlib
+import functools
+
+
+# Newest rules file version this build understands
+RULES_VERSION = 1
+
+# Rules file shipped next to this module
+DEFAULT_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'ITG_export_scrub_rules.json')
+
+
+class ScrubRules:
+    """Compiled scrub rules. Global lists are frozensets and
+    per-csv overrides are merged once per file name."""
+
+    def __init__(self, data, source=''):
+        version = data.get('version', 1)
+        if version > RULES_VERSION:
+            raise ValueError(f'Rules file {source} is version {version}, '
+                             f'this build supports up to {RULES_VERSION}.')
+        self.version = version
+        self.source = source
+        # Identifies these exact rules, so outputs made with other
+        # rules are not treated as up to date
+        fingerprint = hashlib.sha256(
+            json.dumps(data, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+        self.key = f'{version}:{fingerprint[:16]}'
+
+        # Keep the listed order for csv's, it is the sheet order
+        self.keep_csv = tuple(data.get('keep_csv', []))
+        self.sorters = frozenset(data.get('sorters', []))
+        self.delete_columns = frozenset(data.get('delete_columns', []))
+        self.overrides = data.get('overrides', {})
+
+        self._delete_columns = {}
+        self._sorters = {}
+        self._column_plans = {}
+
+    def delete_columns_for(self, file) -> frozenset:
+        """Columns always deleted from one csv
+
+        :param file: csv file name inside the export
+        :return: frozenset of column names
+        """
+
+        if file not in self._delete_columns:
+            override = self.overrides.get(file, {})
+            columns = set(self.delete_columns)
+            columns.update(override.get('delete_columns', []))
+            columns.difference_update(override.get('keep_columns', []))
+            self._delete_columns[file] = frozenset(columns)
+        return self._delete_columns[file]
+
+    def sorters_for(self, file) -> frozenset:
+        """Column names a csv is sorted by if left in the first column
+
+        :param file: csv file name inside the export
+        :return: frozenset of column names
+        """
+
+        if file not in self._sorters:
+            override = self.overrides.get(file, {})
+            if 'sorters' in override:
+                self._sorters[file] = frozenset(override['sorters'])
+            else:
+                self._sorters[file] = self.sorters
+        return self._sorters[file]
+
+    def sort_keys_for(self, file, headers) -> tuple:
+        """Columns a sheet is sorted by, primary first. A sort_by
+        override lists them for one csv, and those deleted or left
+        empty are skipped. Otherwise the sheet is sorted by its first
+        column if that is a sorter.
+
+        :param file: csv file name inside the export
+        :param headers: header names left in the sheet, in order
+        :return: tuple of column names, empty for no sort
+        """
+
+        override = self.overrides.get(file, {})
+        if 'sort_by' in override:
+            return tuple(h for h in override['sort_by'] if h in headers)
+        if headers and headers[0] in self.sorters_for(file):
+            return (headers[0],)
+        return ()
+
+    def column_plan(self, file, headers) -> tuple:
+        """Indexes of the columns of a csv that are not always deleted.
+        Plans are cached per file name and header row, so exports with
+        the same layout reuse them.
+
+        :param file: csv file name inside the export
+        :param headers: list of csv header names
+        :return: tuple of column indexes in header order
+        """
+
+        key = (file, tuple(headers))
+        if key not in self._column_plans:
+            delete_columns = self.delete_columns_for(file)
+            self._column_plans[key] = tuple(
+                i for i, h in enumerate(headers) if h not in delete_columns
+            )
+        return self._column_plans[key]
+
+
+@functools.lru_cache(maxsize=None)
+def load_rules(rules_file=DEFAULT_RULES_FILE) -> ScrubRules:
+    """Read and compile a rules file. Each file is only read once
+    per process.
+
+    :param rules_file: path to a JSON rules file
+    :return: ScrubRules
+    """
+
+    with open(rules_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return ScrubRules(data, source=rules_file)
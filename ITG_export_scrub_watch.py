@@ -0,0 +1,252 @@
+"""
+ITG_export_scrub_watch.py
+
+Author: Josh Smith
+
+Purpose: Watch one or more directories for export zips dropped in by the
+ITG export job and scrub each one once it has finished copying. Zips are
+scrubbed in a process pool with a fixed number of workers, and every
+finished, failed or skipped zip is appended to a JSON-lines watch log.
+Zips that fail for a transient reason are picked up again on a later scan.
+See 'TPG ITG Export Scrubber Specification.rst' for more info.
+"""
+
+# imports
+import os
+from os.path import basename
+import datetime
+import json
+import signal
+import time
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import ITG_export_scrub_engine as engine
+
+
+# Watch log status of each result
+WATCH_STATUS = {engine.RESULT_OK: 'finished',
+                engine.RESULT_ERROR: 'failed',
+                engine.RESULT_SKIPPED: 'skipped'}
+
+
+def watch_log_path(working_dir) -> str:
+    """Return the path of today's JSON-lines watch log in working_dir
+
+    :param working_dir: directory the watch log is kept in
+    :return: full path to the jsonl file
+    """
+
+    return os.path.join(working_dir, f'ITG_scrubber_watch_'
+                                     f'{datetime.date.today()}.jsonl')
+
+
+def _zip_state(path):
+    """Return the size and modification time of path, or None if it
+    is gone"""
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _ignore_interrupt() -> None:
+    """Pool worker initializer. Ctrl+C in a terminal reaches the whole
+    process group, so workers ignore it and finish their export while
+    the watcher stops taking new ones."""
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _can_open(path) -> bool:
+    """Check that nothing still holds path open for writing.
+    Windows refuses to open a file another process is writing."""
+
+    try:
+        with open(path, 'rb'):
+            return True
+    except OSError:
+        return False
+
+
+class FolderWatcher:
+    """Poll directories for new or changed export zips and scrub them.
+    A zip is only queued once its size and modification time have not
+    changed for settle seconds, so half copied exports are left alone."""
+
+    def __init__(self, directories, options=None, workers=1, rules=None,
+                 interval=5.0, settle=10.0, force=False, progress=None,
+                 retries=engine.DEFAULT_RETRIES,
+                 retry_wait=engine.DEFAULT_RETRY_DELAY):
+        """
+        :param directories: list of directories to watch
+        :param options: ScrubOptions of every export scrubbed
+        :param workers: most exports scrubbed at the same time
+        :param rules: compiled ScrubRules, defaults to the rules file
+                        shipped with the scrubber.
+        :param interval: seconds between directory scans
+        :param settle: seconds a zip must stay unchanged before it is
+                        scrubbed
+        :param force: scrub zips the manifest shows are up to date
+        :param progress: optional callable taking a status message string.
+        :param retries: times a zip that failed for a transient reason
+                        (locked, share unavailable) is scrubbed again
+        :param retry_wait: seconds before a failed zip is looked at
+                        again, doubled on every further retry
+        """
+
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.options = options or engine.ScrubOptions()
+        self.workers = max(1, workers)
+        self.rules = rules or engine.load_rules()
+        self.interval = interval
+        self.settle = settle
+        self.force = force
+        self.progress = progress or (lambda message: None)
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.manifests = engine.batch_manifests(self.rules, self.options)
+
+        # zip:(state, time first seen in that state) of unsettled zips
+        self.pending = {}
+        # zip:state of every zip handled, so it is only scrubbed again
+        # when it changes. Outputs written here are added too.
+        self.handled = {}
+        self.queue = deque()
+        self.running = {}
+        # zip:failed attempts of zips waiting to be retried, and the
+        # time.monotonic() they may be looked at again
+        self.attempts = {}
+        self.retry_after = {}
+        self.counts = {status: 0 for status in WATCH_STATUS.values()}
+
+    def scan(self) -> list:
+        """Check the watched directories once
+
+        :return: list of (zip, state) tuples that have settled
+        """
+
+        now = time.monotonic()
+        busy = {input_zip for input_zip, _ in self.queue}
+        busy.update(input_zip for input_zip, _ in self.running.values())
+        found = set()
+        ready = []
+        for input_zip in engine.find_exports(self.directories):
+            if input_zip in busy or self.retry_after.get(input_zip, 0) > now:
+                continue
+            state = _zip_state(input_zip)
+            if state is None or self.handled.get(input_zip) == state:
+                continue
+            found.add(input_zip)
+            seen = self.pending.get(input_zip)
+            if seen is None or seen[0] != state:
+                # New, or still being written
+                self.pending[input_zip] = (state, now)
+            elif now - seen[1] >= self.settle and _can_open(input_zip):
+                del self.pending[input_zip]
+                ready.append((input_zip, state))
+
+        # Forget zips that were removed before they settled
+        for input_zip in set(self.pending) - found:
+            del self.pending[input_zip]
+        return ready
+
+    def _queue_ready(self) -> None:
+        """Queue settled zips, skipping ones already up to date"""
+
+        for input_zip, state in self.scan():
+            if not self.force and self.manifests.is_current(input_zip):
+                self.handled[input_zip] = state
+                self._record(input_zip, engine.RESULT_SKIPPED, None)
+            else:
+                self.progress(f'Queued {basename(input_zip)}')
+                self.queue.append((input_zip, state))
+
+    def _collect(self, finished) -> None:
+        """Record the result of every finished future"""
+
+        for future in finished:
+            input_zip, state = self.running.pop(future)
+            result, output, failure, changes = engine.collect_result(
+                input_zip, future)
+            if failure in engine.TRANSIENT_FAILURES:
+                attempts = self.attempts.get(input_zip, 0) + 1
+                if attempts <= self.retries:
+                    # Left unhandled, so scans queue it again once the
+                    # wait is over and it has settled
+                    delay = engine.retry_delay(attempts - 1,
+                                               self.retry_wait)
+                    self.attempts[input_zip] = attempts
+                    self.retry_after[input_zip] = time.monotonic() + delay
+                    self.progress(f'{basename(input_zip)} failed '
+                                  f'({failure}), it will be retried in '
+                                  f'{delay:g} seconds')
+                    continue
+            self.attempts.pop(input_zip, None)
+            self.retry_after.pop(input_zip, None)
+            self.handled[input_zip] = state
+            # Do not pick up our own zipped output
+            for written in (output, changes):
+                if written is not None:
+                    self.handled[written] = _zip_state(written)
+            self.manifests.record(input_zip, output)
+            self._record(input_zip, result, output)
+        self.manifests.save()
+
+    def _record(self, input_zip, result, output) -> None:
+        """Append one result to the watch log of the zip's directory"""
+
+        status = WATCH_STATUS[result]
+        self.counts[status] += 1
+        self.progress(f'{status.capitalize()} {basename(input_zip)}')
+        working_dir = os.path.dirname(os.path.abspath(input_zip))
+        with open(watch_log_path(working_dir), 'a', encoding='utf-8') as f:
+            f.write(json.dumps({
+                'time': datetime.datetime.now().isoformat(
+                    timespec='seconds'),
+                'input_zip': os.path.abspath(input_zip),
+                'status': status,
+                'output': output,
+            }) + '\n')
+
+    def run(self, stop=None) -> dict:
+        """Watch until stop is set or Ctrl+C is pressed. Exports already
+        running are finished before returning.
+
+        :param stop: optional threading.Event to end the watch
+        :return: dictionary of status:count of zips handled
+        """
+
+        stop = stop or threading.Event()
+        self.progress(f'Watching {", ".join(self.directories)} '
+                      f'with {self.workers} worker(s). '
+                      f'Press Ctrl+C to stop.')
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 initializer=_ignore_interrupt) as executor:
+            try:
+                while not stop.is_set():
+                    self._queue_ready()
+                    # Bounded concurrency, the rest wait in the queue
+                    while self.queue and len(self.running) < self.workers:
+                        input_zip, state = self.queue.popleft()
+                        self.progress(f'Processing {basename(input_zip)} ...')
+                        future = executor.submit(
+                            engine.scrub_export, input_zip, self.options,
+                            rules=self.rules
+                        )
+                        self.running[future] = (input_zip, state)
+                    if self.running:
+                        finished, _ = wait(self.running,
+                                           timeout=self.interval,
+                                           return_when=FIRST_COMPLETED)
+                        self._collect(finished)
+                    else:
+                        stop.wait(self.interval)
+            except KeyboardInterrupt:
+                self.progress('Stopping. Waiting for exports already '
+                              'running to finish ...')
+            finally:
+                self._collect(wait(self.running).done)
+        return dict(self.counts)
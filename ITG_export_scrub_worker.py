@@ -0,0 +1,248 @@
+"""
+ITG_export_scrub_worker.py
+
+Author: Josh Smith
+
+Purpose: Persistent scrub worker. One warm interpreter, with pandas,
+xlsxwriter and the html parser already imported and the rules already
+loaded, scrubs export after export sent to it as JSON lines on stdin or
+over a local TCP socket. Scripts that scrub one zip at a time no longer
+pay the start up cost for every zip.
+See 'TPG ITG Export Scrubber Specification.rst' for more info.
+"""
+
+# imports
+import argparse
+import json
+import os
+import socketserver
+import sys
+import time
+import ITG_export_scrub_engine as engine
+from ITG_export_scrub_rules import load_rules, DEFAULT_RULES_FILE
+from ITG_export_scrub_archive import DEFAULT_COMPRESSION
+from ITG_export_scrub_cli import compression_setting, megabytes
+
+
+# Only local scripts may send exports to the worker
+HOST = '127.0.0.1'
+
+
+class ScrubWorker:
+    """Scrub one export per request. The rules and the manifests used
+    to skip unchanged exports are loaded once and kept between
+    requests. Options that change the output are fixed when the worker
+    starts, so every request shares the same manifests."""
+
+    def __init__(self, rules=None, options=None, force=False,
+                 progress=None):
+        """
+        :param rules: compiled ScrubRules, defaults to the rules file
+                        shipped with the scrubber.
+        :param options: ScrubOptions of every request. A request may
+                        only change the post task.
+        :param force: default for scrubbing exports the manifest shows
+                        are up to date
+        :param progress: optional callable taking a status message string.
+        """
+
+        self.rules = rules or load_rules()
+        self.options = options or engine.ScrubOptions()
+        self.force = force
+        self.progress = progress
+        self.manifests = engine.batch_manifests(self.rules, self.options)
+
+    def handle(self, line) -> dict:
+        """Scrub the export named in one request line. A line is either
+        a zip path, or a JSON object with "zip" and optionally
+        "post_task" and "force".
+
+        :param line: request line, without the newline
+        :return: JSON serializable response
+        """
+
+        try:
+            request = json.loads(line) if line.startswith('{') \
+                else {'zip': line}
+            input_zip = os.path.abspath(request['zip'])
+        except (ValueError, KeyError, TypeError) as err:
+            return {'error': f'Bad request {line!r}: {err}'}
+        options = self.options
+        if 'post_task' in request:
+            options = options.replace(post_task=request['post_task'])
+        force = request.get('force', self.force)
+
+        start = time.perf_counter()
+        if not force and self.manifests.is_current(input_zip):
+            result, output, failure, changes = (
+                engine.RESULT_SKIPPED, self.manifests.output(input_zip),
+                None, None)
+        else:
+            try:
+                result, output, failure, changes = engine.scrub_export(
+                    input_zip, options, self.progress, self.rules
+                )
+            except Exception:
+                result, output, failure, changes = \
+                    engine.unexpected_failure(input_zip)
+            self.manifests.record(input_zip, output)
+            self.manifests.save()
+        return {
+            'zip': input_zip,
+            'result': engine.RESULT_NAMES[result],
+            'output': output,
+            'failure': failure,
+            'delta': changes,
+            'seconds': round(time.perf_counter() - start, 4),
+        }
+
+    def serve_lines(self, lines, send) -> int:
+        """Answer every request line until the lines run out
+
+        :param lines: iterable of request lines
+        :param send: callable taking one response line
+        :return: number of requests answered
+        """
+
+        count = 0
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            send(json.dumps(self.handle(line)) + '\n')
+            count += 1
+        return count
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Answer the request lines of one socket connection"""
+
+    def handle(self):
+        def send(response):
+            self.wfile.write(response.encode('utf-8'))
+            self.wfile.flush()
+
+        lines = (raw.decode('utf-8') for raw in self.rfile)
+        self.server.worker.serve_lines(lines, send)
+
+
+class WorkerServer(socketserver.TCPServer):
+    """Local TCP server handing each connection to one ScrubWorker.
+    Connections are answered one at a time, so exports never run
+    side by side in the one interpreter."""
+
+    allow_reuse_address = True
+
+    def __init__(self, worker, port=0):
+        super().__init__((HOST, port), _RequestHandler)
+        self.worker = worker
+
+
+def main(argv=None) -> int:
+    """Parse arguments, warm up and answer requests until stdin ends
+    or Ctrl+C is pressed
+
+    :param argv: argument list, defaults to sys.argv[1:]
+    :return: exit code. 2 means the rules file could not be used.
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Keep one warm scrubber running and scrub the export '
+                    'zips sent to it, one JSON line per request.'
+    )
+    parser.add_argument('--port', type=int,
+                        help=f'listen on {HOST} at this port (0 picks a '
+                             f'free one) instead of reading stdin')
+    parser.add_argument('--post-job', choices=['Delete', 'Keep'],
+                        default='Keep',
+                        help='default for deleting or keeping the original '
+                             'export when finished (default: Keep)')
+    parser.add_argument('--zip', dest='zip_task', choices=['Yes', 'No'],
+                        default='No',
+                        help='zip the output when finished (default: No)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='processes reading the csv\'s of each export '
+                             '(default: 1)')
+    parser.add_argument('--compression', type=compression_setting,
+                        default=DEFAULT_COMPRESSION,
+                        help='compression of output zips as method[:level] '
+                             '(default: stored)')
+    parser.add_argument('--format', dest='output_format',
+                        choices=engine.OUTPUT_FORMATS, default='xlsx',
+                        help='output format (default: xlsx)')
+    parser.add_argument('--low-memory', action='store_true',
+                        help='use the low memory streaming writer')
+    parser.add_argument('--rules', default=DEFAULT_RULES_FILE,
+                        help='JSON scrub rules file (default: the rules '
+                             'file shipped with the scrubber)')
+    parser.add_argument('--html-cache',
+                        help='SQLite file caching cleaned html cells '
+                             'across runs, on a local disk')
+    parser.add_argument('--delta', action='store_true',
+                        help='also write the changes since the last scrub '
+                             'of each client to <customer>_export_delta.xlsx')
+    parser.add_argument('--memory-budget', type=float,
+                        help='MB an export may hold in memory before it '
+                             'falls back to low memory mode')
+    parser.add_argument('--time-limit', type=float,
+                        help='seconds an export may take before it is '
+                             'stopped and logged as an error')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='default for scrubbing exports the manifest '
+                             'shows are already up to date')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not print progress messages to stderr')
+    args = parser.parse_args(argv)
+
+    try:
+        rules = load_rules(args.rules)
+    except (OSError, ValueError) as err:
+        print(f'Could not load rules file {args.rules}: {err}',
+              file=sys.stderr)
+        return 2
+
+    def progress(message):
+        print(message, file=sys.stderr)
+
+    options = engine.ScrubOptions(
+        post_task=args.post_job,
+        zip_task=args.zip_task,
+        low_memory=args.low_memory,
+        output_format=args.output_format,
+        compression=args.compression,
+        sheet_workers=args.workers,
+        html_cache=args.html_cache,
+        delta=args.delta,
+        memory_budget=megabytes(args.memory_budget),
+        time_limit=args.time_limit
+    )
+    worker = ScrubWorker(rules, options, args.force,
+                         None if args.quiet else progress)
+    ready = {'ready': True, 'import_seconds': round(engine.warm_up(), 4)}
+
+    # Responses go to stdout, progress messages to stderr
+    if args.port is None:
+        print(json.dumps(ready), flush=True)
+
+        def send(response):
+            sys.stdout.write(response)
+            sys.stdout.flush()
+
+        try:
+            worker.serve_lines(sys.stdin, send)
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    with WorkerServer(worker, args.port) as server:
+        ready['port'] = server.server_address[1]
+        print(json.dumps(ready), flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())